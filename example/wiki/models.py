@@ -30,7 +30,7 @@ class Page(db.Model):
 class Revision(db.Model):
     page = db.ManyToOne(Page, reverse_name='revisions')
     timestamp = db.DateTime(default_now=True)
-    text = db.Text()
+    text = db.Text(lazy=True)
     note = db.String(size=200)
 
     @property
@@ -56,43 +56,19 @@ def parse_rst(markup):
         settings_overrides={'_disable_config': True})
     return parts['html_body']
 
-class Pagination(object):
+class Pagination(db.Paginator):
     """
     Paginate a query object.
     """
 
-    def __init__(self, query, per_page, page, endpoint):
-        self.query = query
-        self.per_page = per_page
-        self.page = page
+    def __init__(self, query, per_page, endpoint, after=None, before=None):
+        super(Pagination, self).__init__(query, per_page, after, before)
         self.endpoint = endpoint
-        self._count = None
-
-    @property
-    def entries(self):
-        return self.query.fetch(self.per_page, (self.page - 1) * self.per_page)
-
-    @property
-    def has_previous(self):
-        return self.page > 1
-
-    @property
-    def has_next(self):
-        return self.page < self.pages
 
     @property
     def previous(self):
-        return url_for(self.endpoint, page=self.page - 1)
+        return url_for(self.endpoint, before=self.previous_cursor)
 
     @property
     def next(self):
-        return url_for(self.endpoint, page=self.page + 1)
-
-    @property
-    def count(self):
-        return self.query.count()
-
-    @property
-    def pages(self):
-        return max(0, self.count - 1) // self.per_page + 1
-
+        return url_for(self.endpoint, after=self.next_cursor)
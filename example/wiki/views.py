@@ -66,7 +66,8 @@ def log(name):
     revision = Page.by_name(name)
     if revision is None:
         return show(name)
-    revisions = revision.page.revisions.all().order('-timestamp').fetch(-1)
+    revisions = revision.page.revisions.all().order('-timestamp') \
+                                       .prefetch('page').fetch(-1)
     return web.render_template('log.html', revision=revision, revisions=revisions)
 
 @web.route('/<name>/diff')
@@ -168,7 +169,10 @@ def index():
 
 @web.route('/Spacial:Recent_Changes')
 def changes():
-    page = max(1, request.args.get('page', type=int))
-    query = Revision.all().order('-timestamp')
-    return web.render_template('changes.html',
-        pagination=Pagination(query, 20, page, 'changes'))
+    query = Revision.all().order('-timestamp').prefetch('page')
+    try:
+        pagination = Pagination(query, 20, 'changes',
+            after=request.args.get('after'), before=request.args.get('before'))
+    except ValueError:
+        return web.redirect(web.url_for('changes'))
+    return web.render_template('changes.html', pagination=pagination)
@@ -11,6 +11,7 @@ DATABASE_USER = ""
 DATABASE_PASSWORD = ""
 DATABASE_HOST = ""
 DATABASE_PORT = ""
+DATABASE_OPTIONS = {}
 
 USE_I18N = True
 
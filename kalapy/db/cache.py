@@ -0,0 +1,269 @@
+"""
+kalapy.db.cache
+~~~~~~~~~~~~~~~
+
+This module implements a second level cache of the model records, used by
+:meth:`kalapy.db.Model.get` to serve the records by their keys without
+querying the database. It also caches the query results of the queries
+marked with :meth:`kalapy.db.Query.cache`.
+
+Only the models declaring ``__cache__`` attribute are cached. The value of
+the attribute can be ``True`` or the number of seconds the cached records
+should be kept for::
+
+    class Country(db.Model):
+        __cache__ = 3600
+        code = db.String(size=2)
+        name = db.String()
+
+The cache backend is configured with ``cache`` option of the
+``settings.DATABASE_OPTIONS``, which can be ``memory`` for an in-process
+LRU cache or ``memcached`` for memcached servers.
+
+The cached records are invalidated by the database engines whenever they
+are updated or deleted. The cached query results of a model are discarded
+whenever any of its records is created, updated or deleted. Both are
+discarded once again when the transaction is committed or rolled back, as
+other requests might have cached them in the meantime.
+
+:copyright: (c) 2010 Amit Mendapara.
+:license: BSD, see LICENSE for more details.
+"""
+import itertools, threading
+from time import time
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+from werkzeug.contrib.cache import BaseCache, MemcachedCache, GAEMemcachedCache
+
+from kalapy.conf import settings
+from kalapy.core.pool import pool
+
+
+__all__ = ('LRUCache',)
+
+
+class LRUCache(BaseCache):
+    """An in-process cache which discards the least recently used items
+    when the number of items exceeds the given size. Unlike the memcached
+    the values are not pickled, so they should be treated as readonly.
+
+    :param size: the maximum number of items to keep
+    :param default_timeout: the default timeout in seconds, 0 means never
+                            expire
+    """
+
+    def __init__(self, size=1000, default_timeout=300):
+        BaseCache.__init__(self, default_timeout)
+        self._size = size
+        self._cache = {}
+        self._ticks = itertools.count()
+        self._lock = threading.Lock()
+
+    def _prune(self):
+        # discard quarter of the least recently used items at once to keep
+        # the cost of sorting amortized
+        items = self._cache.items()
+        items.sort(lambda a, b: cmp(a[1][0], b[1][0]))
+        for key, __ in items[:max(1, len(items) / 4)]:
+            del self._cache[key]
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            item = self._cache.get(key)
+            if item is None:
+                return None
+            if item[1] and item[1] <= time():
+                del self._cache[key]
+                return None
+            item[0] = self._ticks.next()
+            return item[2]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        expires = time() + timeout if timeout else 0
+        self._lock.acquire()
+        try:
+            if key not in self._cache and len(self._cache) >= self._size:
+                self._prune()
+            self._cache[key] = [self._ticks.next(), expires, value]
+        finally:
+            self._lock.release()
+
+    def add(self, key, value, timeout=None):
+        if self.get(key) is None:
+            self.set(key, value, timeout)
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            self._cache.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._cache.clear()
+        finally:
+            self._lock.release()
+
+
+#: the configured cache backends by name
+_backends = {}
+
+def get_cache():
+    """Returns the cache backend configured with ``cache`` option of the
+    ``settings.DATABASE_OPTIONS`` or None if not configured.
+    """
+    options = settings.DATABASE_OPTIONS
+    name = options.get('cache')
+    if not name:
+        return None
+    try:
+        return _backends[name]
+    except KeyError:
+        pass
+    timeout = options.get('cache_timeout', 300)
+    if name == 'memory':
+        backend = LRUCache(options.get('cache_size', 1000), timeout)
+    elif name == 'memcached':
+        if settings.DATABASE_ENGINE == 'gae':
+            backend = GAEMemcachedCache(timeout, 'kalapy:')
+        else:
+            backend = MemcachedCache(
+                options.get('memcached_servers', []), timeout, 'kalapy:')
+    else:
+        raise ValueError(_('Cache backend %(name)r not supported.', name=name))
+    return _backends.setdefault(name, backend)
+
+
+_tokens = itertools.count()
+
+def _version(cache, model, renew=False, kind='version'):
+    """Returns the version token of the given model. All the cached records
+    (or query results if kind is `query`) of a model are discarded by renewing
+    its version token.
+    """
+    key = '%s:%s' % (kind, model._meta.table)
+    token = None if renew else cache.get(key)
+    if token is None:
+        token = '%x.%x' % (int(time() * 1000000), _tokens.next())
+        cache.set(key, token, 0)
+    return token
+
+def _key(model, version, key):
+    return 'record:%s:%s:%s' % (model._meta.table, version, key)
+
+def _timeout(model):
+    timeout = model._meta.cache
+    return None if timeout is True else timeout
+
+def get_records(model, keys):
+    """Get the cached records of the given model.
+
+    :param model: a model class
+    :param keys: list of record keys
+
+    :returns: a dict of key and the database values of the cached records
+    """
+    cache = get_cache()
+    if cache is None or not model._meta.cache:
+        return {}
+    version = _version(cache, model)
+    values = cache.get_many(*[_key(model, version, k) for k in keys])
+    return dict([(k, v) for k, v in zip(keys, values) if v is not None])
+
+def set_records(model, rows):
+    """Cache the given records of the given model.
+
+    :param model: a model class
+    :param rows: list of database values of the records as fetched from
+                 the database, including the `key`
+    """
+    cache = get_cache()
+    if cache is None or not model._meta.cache or not rows:
+        return
+    version = _version(cache, model)
+    mapping = {}
+    for row in rows:
+        mapping[_key(model, version, row['key'])] = dict(row)
+    cache.set_many(mapping, _timeout(model))
+
+def get_result(models, statement, timeout, func):
+    """Get the cached result of the given query statement or cache the result
+    returned by calling the given function.
+
+    The result is discarded when the records of any of the given models are
+    changed, so all the models read by the query (including the nested
+    queries) should be given.
+
+    :param models: list of the model classes being queried
+    :param statement: the query statement (for example, sql and params) which
+                      uniquely identifies the result
+    :param timeout: the cache timeout in seconds, True for the default
+    :param func: a function returning the result of the query
+
+    :returns: the query result
+    """
+    cache = get_cache()
+    if cache is None:
+        return func()
+    key = 'result:%s:%s:%s' % (models[0]._meta.table,
+        ':'.join([_version(cache, m, kind='query') for m in models]),
+        md5(repr(statement)).hexdigest())
+    result = cache.get(key)
+    if result is None:
+        result = func()
+        cache.set(key, result, None if timeout is True else timeout)
+    return result
+
+def invalidate(model, keys=None):
+    """Discard the cached records and query results of the given model.
+
+    If keys are not given, all the cached records of the model and the
+    models referencing it (changed by foreign key constraints) are
+    discarded.
+
+    :param model: a model class
+    :param keys: list of record keys
+    """
+    cache = get_cache()
+    if cache is None:
+        return
+    if keys is not None:
+        _version(cache, model, renew=True, kind='query')
+        if model._meta.cache:
+            version = _version(cache, model)
+            for key in keys:
+                cache.delete(_key(model, version, key))
+        return
+    for cls in referencing(model) + [model]:
+        _version(cache, cls, renew=True, kind='query')
+        if cls._meta.cache:
+            _version(cache, cls, renew=True)
+
+def referencing(model):
+    """Returns the list of models referencing the given model directly
+    or indirectly.
+    """
+    result = []
+    names = set([model._meta.name])
+    changed = True
+    while changed:
+        changed = False
+        for cls in pool.get_models():
+            if cls._meta.name in names:
+                continue
+            if [m for m in cls._meta.ref_models if m._meta.name in names]:
+                names.add(cls._meta.name)
+                result.append(cls)
+                changed = True
+    return result
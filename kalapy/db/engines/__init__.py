@@ -15,6 +15,7 @@ from werkzeug.local import LocalStack
 
 from kalapy.conf import settings
 from kalapy.core import signals
+from kalapy.db.engines.pool import ConnectionPool
 
 
 __all__ = ('Database', 'DatabaseError', 'IntegrityError', 'database')
@@ -35,6 +36,26 @@ DatabaseError = engine.DatabaseError
 IntegrityError = engine.IntegrityError
 
 
+def _create_database():
+    return Database(
+        name=settings.DATABASE_NAME,
+        host=settings.DATABASE_HOST,
+        port=settings.DATABASE_PORT,
+        user=settings.DATABASE_USER,
+        password=settings.DATABASE_PASSWORD)
+
+
+_options = settings.DATABASE_OPTIONS
+
+#: the database connection pool
+pool = ConnectionPool(_create_database,
+    max_size=_options.get('pool_max_size', 0),
+    min_size=_options.get('pool_min_size', 0),
+    idle_timeout=_options.get('pool_idle_timeout', 300),
+    timeout=_options.get('pool_timeout', 30),
+    pre_ping=_options.get('pool_pre_ping', False))
+
+
 class Connection(object):
 
     __ctx = LocalStack()
@@ -46,19 +67,20 @@ class Connection(object):
 
     def connect(self):
         if self.__ctx.top is None:
-            db = Database(
-                    name=settings.DATABASE_NAME,
-                    host=settings.DATABASE_HOST,
-                    port=settings.DATABASE_PORT,
-                    user=settings.DATABASE_USER,
-                    password=settings.DATABASE_PASSWORD)
-            self.__ctx.push(db)
+            self.__ctx.push(pool.checkout())
         self.__ctx.top.connect()
 
     def close(self):
         if self.__ctx.top is not None:
-            self.__ctx.top.close()
-            self.__ctx.pop()
+            pool.checkin(self.__ctx.pop())
+
+    def current(self):
+        """Returns the :class:`Database` instance of the current context,
+        connecting it if required.
+        """
+        if self.__ctx.top is None:
+            self.connect()
+        return self.__ctx.top
 
 
 #: context local database connection
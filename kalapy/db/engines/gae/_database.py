@@ -8,6 +8,7 @@ Implementes Google AppEngine backend.
 :license: BSD, see LICENSE for more details.
 """
 import re
+from copy import deepcopy
 from itertools import chain
 
 try:
@@ -19,8 +20,10 @@ except ImportError:
 
 from google.appengine.api import datastore_errors, datastore_types
 
+from kalapy.db import cache
 from kalapy.db.engines.interface import IDatabase
 from kalapy.db.model import Model
+from kalapy.db.query import QSet
 from kalapy.conf import settings
 
 __all__ = ('DatabaseError', 'IntegrityError', 'Database')
@@ -81,7 +84,7 @@ class Database(IDatabase):
     def drop_table(self, model):
         model.all().delete()
 
-    def update_records(self, instance, *args):
+    def update_records(self, instance, *args, **kw):
 
         result = []
         instances = [instance]
@@ -94,6 +97,8 @@ class Database(IDatabase):
 
             if not obj.is_saved:
                 obj._payload = datastore.Entity(obj._meta.table)
+            else:
+                cache.invalidate(obj.__class__, [obj.key])
 
             # test unique contraints
             if self.check_unique:
@@ -122,6 +127,7 @@ class Database(IDatabase):
 
         keys = [obj.key for obj in instances]
         datastore.Delete(keys)
+        cache.invalidate(instance.__class__, keys)
 
         for obj in instances:
             obj._key = None
@@ -130,14 +136,25 @@ class Database(IDatabase):
         return keys
 
     def fetch(self, qset, limit, offset):
+        seek = qset.seek
+        qset = self._resolve(qset)
         limit = datastore.MAXIMUM_RESULTS if limit == -1 else limit
-        orderings = []
-        try:
-            name, how = qset.order
-            how = Query.ASCENDING if how == 'ASC' else Query.DESCENDING
-            orderings = [(name, how)]
-        except:
-            pass
+
+        columns = qset.order or ()
+        if seek or qset.keyset:
+            columns = qset.seek_columns()
+        if seek and seek[0] == 'before':
+            flip = {'ASC': 'DESC', 'DESC': 'ASC'}
+            columns = [(name, flip[how]) for name, how in columns]
+        orderings = [(name == 'key' and '__key__' or name,
+                      Query.ASCENDING if how == 'ASC' else Query.DESCENDING) \
+                     for name, how in columns]
+
+        # the datastore allows inequality filters on a single property only,
+        # so the records are sorted and seeked in memory
+        count, skip = limit, offset
+        if seek:
+            count, skip = datastore.MAXIMUM_RESULTS, 0
 
         keys = self._keys(qset)
         result = []
@@ -146,7 +163,7 @@ class Database(IDatabase):
             result = [e for e in datastore.Get(keys) if e]
         else: # else build query, the results should be ANDed
             query_set = self._build_query_set(qset, orderings)
-            result_set = [[e for e in q.Get(limit, offset) if e] for q in query_set]
+            result_set = [[e for e in q.Get(count, skip) if e] for q in query_set]
             keys = [set([e.key() for e in result]) for result in result_set]
             keys = reduce(lambda a, b: a & b, keys)
 
@@ -156,12 +173,48 @@ class Database(IDatabase):
                     result.setdefault(e.key(), e)
             result = result.values()
 
-        for e in sort_result(result, orderings)[:limit]:
-            yield dict(e, key=str(e.key()), _payload=e)
+        result = sort_result(result, orderings)
+        if seek:
+            values = [datastore.Key(v) if name == 'key' else v \
+                      for (name, how), v in zip(columns, seek[1])]
+            result = [e for e in result \
+                      if compare(entity_values(e, orderings), values, orderings) > 0]
+            result = result[offset:]
+
+        for e in result[:limit]:
+            if qset.fields:
+                yield dict([(name, str(e.key()) if name == 'key' else e.get(name)) \
+                            for name in qset.fields])
+            else:
+                yield dict(e, key=str(e.key()), _payload=e)
 
     def count(self, qset):
+        if qset.group:
+            return len(self.aggregate(qset, []))
+        qset = self._resolve(qset)
+        # let the datastore count a simple query without fetching entities
+        if not qset.seek and not self._keys(qset) and \
+                not [n for q in qset for n, o, v in q.items if n == 'key']:
+            query_set = self._build_query_set(qset, [])
+            if len(query_set) == 1 and type(query_set[0]) is Query:
+                return query_set[0].Count(datastore.MAXIMUM_RESULTS)
         return len(list(self.fetch(qset, -1, 0)))
 
+    def _resolve(self, qset):
+        """The datastore doesn't support nested queries, so fetch the values
+        selected by the nested queries and filter with them instead.
+        """
+        if not qset.subqueries():
+            return qset
+        qset = deepcopy(qset)
+        for q in qset:
+            for i, (name, op, value) in enumerate(q.items):
+                if isinstance(value, QSet):
+                    field = value.fields[0]
+                    values = [row[field] for row in self.fetch(value, -1, 0)]
+                    q.items[i] = (name, op, values)
+        return qset
+
     def _keys(self, qset):
         if len(qset.items) == 1:
             q = qset.items[0]
@@ -311,20 +364,31 @@ class MultiQuery(datastore.MultiQuery):
         return False
 
 
+def entity_values(e, orderings):
+    """A helper function to get the values of the ordering properties.
+    """
+    return [e.key() if name == '__key__' else e.get(name) \
+            for name, how in orderings]
+
+
+def compare(a, b, orderings):
+    """A helper function to compare the values of the ordering properties.
+    """
+    for (name, how), x, y in zip(orderings, a, b):
+        res = cmp(x, y)
+        if res:
+            return -res if how == Query.DESCENDING else res
+    return 0
+
+
 def sort_result(result, orderings):
     """A helper function to sort the final result.
     """
-    try:
-        name, how = orderings[0]
-    except:
+    if not orderings:
         return result
 
-    def compare(a, b):
-        if how == 2:
-            return -cmp(a[name], b[name])
-        return cmp(a[name], b[name])
-
-    result.sort(compare)
+    result.sort(lambda a, b: compare(entity_values(a, orderings),
+                                     entity_values(b, orderings), orderings))
     return result
 
 
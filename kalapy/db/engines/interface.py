@@ -52,6 +52,13 @@ class IDatabase(object):
         """Rollback all the changes made since the last commit.
         """
         raise NotImplementedError
+
+    def ping(self):
+        """Check whether the database connection is still usable.
+
+        :returns: True if the connection is alive else False
+        """
+        return True
     
     def run_in_transaction(self, func, *args, **kw):
         """A helper function to run the specified func in a transaction. This
@@ -124,16 +131,18 @@ class IDatabase(object):
         """
         raise NotImplementedError
 
-    def update_records(self, instance, *args):
+    def update_records(self, instance, *args, **kw):
         """Update database records for the given model instances.
 
         The implementation should take care of:
 
             - Inserting records if records doesn't exist.
             - Updating `key` value of the given model instances.
+            - Saving instances referenced by other instances first.
 
         :param instance: an instance of :class:`Model` subclass
         :param args: more instances
+        :keyword batch_size: maximum number of records to be inserted at once
 
         :returns: list of key values
         :raises:
@@ -160,6 +169,61 @@ class IDatabase(object):
         """
         raise NotImplementedError
 
+    def update_all(self, qset, values):
+        """Update all the records matched by the given query set with the
+        given values.
+
+        The values can be instances of :class:`db.query.Expr` which should be
+        evaluated against the current values of each record.
+
+        The default implementation loads the matched records and updates them
+        with :meth:`update_records`. Engines should override this method to
+        update records in place if the backend supports it.
+
+        :param qset: the query set, an instance of :class:`db.query.QSet`
+        :param values: mapping of field name and value or expression
+
+        :returns: number of records updated
+        :raises:
+            - :class:`DatabaseError`
+            - :class:`IntegrityError`
+        """
+        from kalapy.db.query import Expr
+        instances = qset.model._from_database_rows(
+                        list(self.fetch(qset, -1, 0)))
+        for obj in instances:
+            for name, value in values.items():
+                if isinstance(value, Expr):
+                    value = value.evaluate(obj)
+                setattr(obj, name, value)
+        if instances:
+            self.update_records(*instances)
+        return len(instances)
+
+    def delete_all(self, qset):
+        """Delete all the records matched by the given query set.
+
+        The default implementation loads the matched records in chunks and
+        deletes them with :meth:`delete_records`. Engines should override this
+        method to delete records in place if the backend supports it.
+
+        :param qset: the query set, an instance of :class:`db.query.QSet`
+
+        :returns: number of records deleted
+        :raises:
+            - :class:`DatabaseError`
+            - :class:`IntegrityError`
+        """
+        result = 0
+        while True:
+            instances = qset.model._from_database_rows(
+                            list(self.fetch(qset, 100, 0)))
+            if not instances:
+                break
+            self.delete_records(*instances)
+            result += len(instances)
+        return result
+
     def fetch(self, qset, limit, offset):
         """Fetch records from database filtered by the given query set bound
         to given limit and offset.
@@ -182,6 +246,85 @@ class IDatabase(object):
         """
         raise NotImplementedError
 
+    def iterate(self, qset, batch_size):
+        """Iterate over all the records matched by the given query set in
+        chunks of `batch_size` records.
+
+        The default implementation pages through the result with :meth:`fetch`.
+        Engines should override this method to stream records from a single
+        cursor if the backend supports it.
+
+        :param qset: the query set, an instance of :class:`db.query.QSet`
+        :param batch_size: number of records per chunk
+
+        :returns: an iterator of lists of dict of name, value mappings
+        :raises:
+            - :class:`db.DatabaseError`
+        """
+        offset = 0
+        while True:
+            rows = list(self.fetch(qset, batch_size, offset))
+            if rows:
+                yield rows
+            if len(rows) < batch_size:
+                break
+            offset += batch_size
+
+    def aggregate(self, qset, aggregates, limit=-1, offset=0):
+        """Compute the given aggregates of the records matched by the given
+        query set, for each group of the records if the query set is grouped
+        (``qset.group``).
+
+        The default implementation streams the records with :meth:`iterate`
+        and reduces them in memory. Engines should override this method to
+        compute the aggregates in the database if the backend supports it.
+
+        :param qset: the query set, an instance of :class:`db.query.QSet`
+        :param aggregates: list of `(name, aggregate)` pairs, where aggregate
+                           is an instance of :class:`db.query.Aggregate`
+        :param limit: number of groups to return, if -1 return all
+        :param offset: offset from where to return the groups
+
+        :returns: list of dict of the grouped fields and the aggregates names
+                  and their database values
+        :raises:
+            - :class:`DatabaseError`
+        """
+        from copy import deepcopy
+        group = qset.group or []
+        q = deepcopy(qset)
+        q.group = q.annotations = q.order = None
+        q.fields = list(set(group + [a.name for n, a in aggregates if a.name]))
+        q.fields = q.fields or ['key']
+
+        groups = {}
+        for rows in self.iterate(q, 500):
+            for row in rows:
+                values = tuple([row[name] for name in group])
+                states = groups.get(values)
+                if states is None:
+                    states = groups[values] = [a.start() for n, a in aggregates]
+                for i, (name, agg) in enumerate(aggregates):
+                    states[i] = agg.step(states[i], row.get(agg.name))
+
+        if not group and not groups:
+            groups[()] = [a.start() for n, a in aggregates]
+
+        result = []
+        for values, states in groups.items():
+            row = dict(zip(group, values))
+            for (name, agg), state in zip(aggregates, states):
+                row[name] = agg.finish(state)
+            result.append(row)
+
+        for name, how in reversed(qset.order or ()):
+            result.sort(key=lambda row: row[name], reverse=how == 'DESC')
+
+        offset = max(offset or 0, 0)
+        if limit > -1:
+            return result[offset:offset + limit]
+        return result[offset:]
+
     def count(self, qset):
         """Returns the total number of records matched by given query set.
 
@@ -193,3 +336,33 @@ class IDatabase(object):
         """
         raise NotImplementedError
 
+    def estimate(self, qset):
+        """Returns the estimated number of records matched by the given query
+        set, computed from the database statistics.
+
+        The default implementation returns None, engines should override this
+        method if the backend can estimate the number cheaply.
+
+        :param qset: the query set, an instance of :class:`db.query.QSet`
+
+        :returns: integer or None if can't be estimated
+        """
+        return None
+
+    def exists(self, qset):
+        """Check whether any record is matched by the given query set.
+
+        The default implementation fetches the key of the first record.
+
+        :param qset: the query set, an instance of :class:`db.query.QSet`
+
+        :returns: True or False
+        :raises:
+            - :class:`DatabaseError`
+        """
+        from copy import deepcopy
+        q = deepcopy(qset)
+        q.order = q.seek = None
+        q.fields = ['key']
+        return bool(list(self.fetch(q, 1, 0)))
+
@@ -9,10 +9,12 @@ MySQL backend engine.
 """
 import MySQLdb as dbapi
 from MySQLdb.converters import conversions
+from MySQLdb.cursors import SSCursor
 from MySQLdb.constants import FIELD_TYPE
 
 from kalapy.db.engines import utils
 from kalapy.db.engines.relational import RelationalDatabase
+from kalapy.db.reference import ManyToOne
 
 
 __all__ = ('DatabaseError', 'IntegrityError', 'Database')
@@ -46,6 +48,7 @@ class Database(RelationalDatabase):
     def __init__(self, name, host=None, port=None, user=None, password=None):
         super(Database, self).__init__(name, host, port, user, password)
         self.connection = None
+        self.autoinc = None
 
     def connect(self):
         if self.connection is not None:
@@ -66,8 +69,27 @@ class Database(RelationalDatabase):
         if self.port:
             args['port'] = self.port
         self.connection = dbapi.connect(**args)
+        self.autoinc = None
         return self
 
+    def commit(self):
+        self.buffer_streams()
+        super(Database, self).commit()
+
+    def cursor(self):
+        # no other statement can be run until the unbuffered result sets
+        # are read completely
+        self.buffer_streams()
+        return super(Database, self).cursor()
+
+    def stream_cursor(self):
+        # use unbuffered cursor, MySQLdb loads complete result set into
+        # client memory otherwise
+        if not self.connection:
+            self.connect()
+        self.buffer_streams()
+        return self.connection.cursor(SSCursor)
+
     def fix_quote(self, sql):
         return sql.replace('"', '`')
 
@@ -84,6 +106,66 @@ class Database(RelationalDatabase):
             """, (model._meta.table, self.name,))
         return bool(cursor.fetchone()[0])
 
-    def lastrowid(self, cursor, model):
-        cursor.execute('SELECT LAST_INSERT_ID()')
-        return cursor.fetchone()[0]
+    def estimate(self, qset):
+        what = ", ".join(['"%s"' % name for name in qset.group or ['key']])
+        sql, params = self.compile(qset, what, order=False)
+        cursor = self.cursor()
+        cursor.execute('EXPLAIN %s' % sql, params)
+        names = [desc[0].lower() for desc in cursor.description]
+        row = cursor.fetchone()
+        if row is None or 'rows' not in names:
+            return None
+        return int(row[names.index('rows')] or 0)
+
+    def exists_index(self, model, name):
+        cursor = self.cursor()
+        cursor.execute("""
+            SELECT COUNT(*)
+                FROM information_schema.statistics
+                    WHERE table_name = %s AND table_schema = %s AND index_name = %s;
+            """, (model._meta.table, self.name, name))
+        return bool(cursor.fetchone()[0])
+
+    def get_indexes(self, model):
+        # InnoDB creates indexes for the foreign keys itself, and partial
+        # indexes are not supported (can't be unique then)
+        fks = [f.name for f in model.fields().values() if isinstance(f, ManyToOne)]
+        declared = [i.fields for i in model._meta.indexes]
+        return [i for i in super(Database, self).get_indexes(model) \
+                if (i.fields in declared or i.fields[0] not in fks) \
+                and not (i.unique and i.where)]
+
+    def drop_index(self, model, name):
+        cursor = self.cursor()
+        cursor.execute(self.fix_quote(
+            'DROP INDEX "%s" ON "%s"' % (name, model._meta.table)))
+
+    def get_index_sql(self, model, index):
+        # partial indexes are not supported, index all the rows
+        sql = 'CREATE %sINDEX "%s" ON "%s" (%s);' % (
+            'UNIQUE ' if index.unique else '', index.name, model._meta.table,
+            ", ".join(['"%s" %s' % c for c in index.columns]))
+        return self.fix_quote(sql)
+
+    def insert_rows(self, cursor, model, names, rows):
+        # InnoDB assigns consecutive keys to the rows inserted by a single
+        # statement, unless the interleaved lock mode is used
+        if self.autoinc is None:
+            cursor.execute(
+                'SELECT @@auto_increment_increment, @@innodb_autoinc_lock_mode')
+            increment, mode = cursor.fetchone()
+            self.autoinc = int(increment) if int(mode) in (0, 1) else 0
+        if not self.autoinc or len(rows) < 2:
+            return super(Database, self).insert_rows(cursor, model, names, rows)
+        values = "(%s)" % ", ".join(['%s'] * len(names))
+        sql = 'INSERT INTO "%s" (%s) VALUES %s' % (
+                model._meta.table,
+                ", ".join(['"%s"' % n for n in names]),
+                ", ".join([values] * len(rows)))
+        params = []
+        for row in rows:
+            params.extend(row)
+        cursor.execute(self.fix_quote(sql), params)
+        # the key of the first inserted row is reported
+        first = cursor.lastrowid
+        return [first + i * self.autoinc for i in range(len(rows))]
@@ -0,0 +1,171 @@
+"""
+kalapy.db.engines.pool
+~~~~~~~~~~~~~~~~~~~~~~
+
+This module implements a pool of database connections, which are checked
+out when a request is started and checked in when it is finished, so that
+the connections are reused across the requests (and threads) instead of
+connecting to the database for every request.
+
+The pool is configured with following options of ``settings.DATABASE_OPTIONS``:
+
+``pool_max_size``
+    The maximum number of connections, pooling is disabled if not set.
+``pool_min_size``
+    The number of connections to keep open even if they are idle.
+``pool_idle_timeout``
+    Number of seconds after which the idle connections are closed.
+``pool_timeout``
+    Number of seconds to wait for a connection if all of them are in use.
+``pool_pre_ping``
+    If True, check that connection is alive before checking it out.
+
+:copyright: (c) 2010 Amit Mendapara.
+:license: BSD, see LICENSE for more details.
+"""
+import threading
+from time import time
+
+
+__all__ = ('ConnectionPool',)
+
+
+class ConnectionPool(object):
+    """A thread-safe pool of database connections.
+
+    :param factory: a callable returning a new `Database` instance
+    :param max_size: the maximum number of connections, if 0 the connections
+                     are not pooled but closed when checked in
+    :param min_size: the number of idle connections to keep open
+    :param idle_timeout: number of seconds after which idle connections
+                         are closed
+    :param timeout: number of seconds to wait for a free connection
+    :param pre_ping: whether to check the connection before checking it out
+    """
+
+    def __init__(self, factory, max_size=0, min_size=0, idle_timeout=300,
+                 timeout=30, pre_ping=False):
+        self.factory = factory
+        self.max_size = max_size
+        self.min_size = min(min_size, max_size)
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.pre_ping = pre_ping
+
+        #: number of connections opened by the pool
+        self.size = 0
+
+        #: idle connections with the time they were checked in
+        self.idle = []
+
+        self._lock = threading.Condition()
+
+    def _connect(self):
+        db = self.factory()
+        db.connect()
+        return db
+
+    def _discard(self, db):
+        try:
+            db.close()
+        except Exception:
+            pass
+
+    def _prune(self):
+        # close connections idle for too long, most recently used
+        # connections are at the end of the list
+        now = time()
+        while len(self.idle) > self.min_size and \
+                now - self.idle[0][1] > self.idle_timeout:
+            db, __ = self.idle.pop(0)
+            self.size -= 1
+            self._discard(db)
+
+    def checkout(self):
+        """Get an idle connection from the pool or open a new one if the pool
+        is not full, else wait till a connection is available.
+
+        :returns: a `Database` instance
+        :raises: :class:`DatabaseError` if no connection is available within
+                 the configured timeout
+        """
+        from kalapy.db.engines import DatabaseError
+        if not self.max_size:
+            return self._connect()
+
+        deadline = time() + self.timeout
+        while True:
+            self._lock.acquire()
+            try:
+                self._prune()
+                db = None
+                while db is None:
+                    if self.idle:
+                        db, __ = self.idle.pop()
+                        break
+                    if self.size < self.max_size:
+                        self.size += 1
+                        break
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        raise DatabaseError(
+                            _('Timed out waiting for a database connection.'))
+                    self._lock.wait(remaining)
+            finally:
+                self._lock.release()
+
+            if db is None:
+                try:
+                    return self._connect()
+                except:
+                    self._release()
+                    raise
+
+            if not self.pre_ping or db.ping():
+                return db
+
+            # stale connection, open a new one
+            self._discard(db)
+            self._release()
+
+    def checkin(self, db):
+        """Return the given connection to the pool. The uncommitted changes
+        are discarded.
+
+        :param db: a `Database` instance returned by :meth:`checkout`
+        """
+        if not self.max_size:
+            self._discard(db)
+            return
+        try:
+            db.rollback()
+        except Exception:
+            self._discard(db)
+            self._release()
+            return
+        self._lock.acquire()
+        try:
+            self.idle.append((db, time()))
+            self._lock.notify()
+        finally:
+            self._lock.release()
+
+    def _release(self):
+        self._lock.acquire()
+        try:
+            self.size -= 1
+            self._lock.notify()
+        finally:
+            self._lock.release()
+
+    def dispose(self):
+        """Close all the idle connections.
+        """
+        self._lock.acquire()
+        try:
+            for db, __ in self.idle:
+                self.size -= 1
+                self._discard(db)
+            self.idle = []
+        finally:
+            self._lock.release()
@@ -7,10 +7,12 @@ PostgreSQL backend engine.
 :copyright: (c) 2010 Amit Mendapara.
 :license: BSD, see LICENSE for more details.
 """
+import re, itertools
+
 import psycopg2 as dbapi
 from psycopg2.extensions import UNICODE
 
-from kalapy.db.engines.relational import RelationalDatabase, QueryBuilder
+from kalapy.db.engines.relational import RelationalDatabase, QueryBuilder, KeyList
 
 
 __all__ = ('DatabaseError', 'IntegrityError', 'Database')
@@ -18,6 +20,8 @@ __all__ = ('DatabaseError', 'IntegrityError', 'Database')
 
 dbapi.extensions.register_type(UNICODE)
 
+_cursor_ids = itertools.count(1)
+
 DatabaseError = dbapi.DatabaseError
 IntegrityError = dbapi.IntegrityError
 
@@ -59,6 +63,22 @@ class Database(RelationalDatabase):
         self.connection.set_isolation_level(1) # make transaction transparent to all cursors
         return self
 
+    def estimate(self, qset):
+        what = ", ".join(['"%s"' % name for name in qset.group or ['key']])
+        sql, params = self.compile(qset, what, order=False)
+        cursor = self.cursor()
+        cursor.execute('EXPLAIN %s' % sql, params)
+        match = re.search(r'rows=(\d+)', cursor.fetchone()[0])
+        return int(match.group(1)) if match else None
+
+    def stream_cursor(self):
+        # use server side (named) cursor, psycopg2 loads complete result set
+        # into client memory otherwise, and keep it open on commit
+        if not self.connection:
+            self.connect()
+        return self.connection.cursor('kalapy_cursor_%d' % _cursor_ids.next(),
+                                      withhold=True)
+
     def exists_table(self, model):
         cursor = self.cursor()
         cursor.execute("""
@@ -67,16 +87,51 @@ class Database(RelationalDatabase):
             """, (model._meta.table,))
         return bool(cursor.fetchone())
 
+    def exists_index(self, model, name):
+        cursor = self.cursor()
+        cursor.execute("""
+            SELECT relname FROM pg_class
+                WHERE relkind = 'i' AND relname = %s;
+            """, (name,))
+        return bool(cursor.fetchone())
+
     def lastrowid(self, cursor, model):
         cursor.execute('SELECT last_value FROM "%s_key_seq"' % model._meta.table)
         return cursor.fetchone()[0]
 
+    def insert_rows(self, cursor, model, names, rows):
+        # get the keys back with the same statement using RETURNING clause
+        values = "(%s)" % ", ".join(['%s'] * len(names))
+        sql = 'INSERT INTO "%s" (%s) VALUES %s RETURNING "key"' % (
+                model._meta.table,
+                ", ".join(['"%s"' % n for n in names]),
+                ", ".join([values] * len(rows)))
+        params = []
+        for row in rows:
+            params.extend(row)
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+    def stage_list(self, field, values, index):
+        # large lists are passed as a single array parameter
+        return KeyList(values)
+
     def query_builder(self, qset):
         return QueryBuilder(qset)
 
 
 class QueryBuilder(QueryBuilder):
 
+    nulls_first = False
+
+    def key_list(self, name, op, value):
+        if op == 'not_in':
+            return '"%s" != ALL(%%s)' % (name)
+        return '"%s" = ANY(%%s)' % (name)
+
+    def key_list_params(self, value):
+        return [list(value)]
+
     def handle_like(self, name, value):
         return '"%s" ILIKE %%s' % (name)
 
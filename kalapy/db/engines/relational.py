@@ -9,25 +9,98 @@ for relational database systems. Engines for an RDBMS should inherit from the
 :copyright: (c) 2010 Amit Mendapara.
 :license: BSD, see LICENSE for more details.
 """
-import re
+import itertools
+from copy import copy, deepcopy
 
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+from kalapy.db import cache
 from kalapy.db.engines.interface import IDatabase
-from kalapy.db.model import Model
+from kalapy.db.identity import IdentityMap
+from kalapy.db.model import Model, Index
+from kalapy.db.query import Expr, QSet
 from kalapy.db.reference import ManyToOne
 
 
-__all__ = ('RelationalDatabase', 'QueryBuilder',)
+__all__ = ('RelationalDatabase', 'QueryBuilder', 'KeyList')
+
+
+class KeyList(list):
+    """A large list of values of an ``IN`` filter, which is loaded in a
+    temporary table instead of passing a parameter for each value (see
+    :meth:`RelationalDatabase.stage_lists`).
+    """
+
+    #: name of the temporary table holding the values
+    table = None
+
+    #: index of the list in the statement
+    index = None
+
+
+class Stream(object):
+    """A cursor streaming the rows of :meth:`RelationalDatabase.iterate`. The
+    remaining rows are fetched into the memory with :meth:`buffer` when the
+    cursor can't be kept open any longer, for example on rollback.
+    """
+
+    def __init__(self, database, cursor):
+        self.database = database
+        self.cursor = cursor
+        self.rows = None
+        self.description = None
+        database.streams.append(self)
+
+    def execute(self, sql, params):
+        return self.cursor.execute(sql, params)
+
+    def buffer(self):
+        if self.rows is None:
+            self.rows = list(self.cursor.fetchall())
+            self.description = self.cursor.description
+
+    def fetchmany(self, size):
+        if self.rows is None:
+            rows = self.cursor.fetchmany(size)
+            # some cursors describe the result after fetching only
+            self.description = self.cursor.description
+            return rows
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def close(self):
+        if self in self.database.streams:
+            self.database.streams.remove(self)
+        self.cursor.close()
 
 
 class RelationalDatabase(IDatabase):
 
     data_types = {}
 
+    #: maximum number of parameters allowed in a single statement, if any
+    max_params = None
+
+    #: compiled select statements, shared by all the connections
+    statements = {}
+
+    #: maximum number of compiled statements to cache
+    max_statements = 1000
+
+    #: maximum number of values of an `IN` list passed as parameters, the
+    #: larger lists are loaded in a temporary table
+    max_in_size = 500
+
     schema_mime = 'text/x-sql'
 
     def __init__(self, name, host=None, port=None, user=None, password=None):
         super(RelationalDatabase, self).__init__(name, host, port, user, password)
         self.connection = None
+        self.invalidated = []
+        self.streams = []
 
     def get_data_type(self, field):
         """Get the internal datatype for the given field supported by the
@@ -49,9 +122,52 @@ class RelationalDatabase(IDatabase):
 
     def commit(self):
         self.connection.commit()
+        # others might have cached the old records before the changes
+        # were committed
+        self.__replay()
 
     def rollback(self):
-        self.connection.rollback()
+        if self.connection:
+            # the open cursors are closed by the rollback
+            self.buffer_streams()
+            self.connection.rollback()
+        # records might have been cached after the changes were made
+        self.__replay()
+        imap = IdentityMap.current()
+        if imap is not None:
+            imap.counts.clear()
+
+    def __replay(self):
+        invalidated, self.invalidated = self.invalidated, []
+        seen = set()
+        for model, keys in invalidated:
+            token = (model, keys if keys is None else tuple(keys))
+            if token not in seen:
+                seen.add(token)
+                cache.invalidate(model, keys)
+
+    def ping(self):
+        if not self.connection:
+            return False
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+            self.connection.rollback()
+        except Exception:
+            return False
+        return True
+
+    def invalidate(self, model, keys=None):
+        """Discard the cached records of the given model, see
+        :func:`kalapy.db.cache.invalidate`, and the counts memoized by the
+        active :class:`IdentityMap`.
+        """
+        cache.invalidate(model, keys)
+        self.invalidated.append((model, keys))
+        imap = IdentityMap.current()
+        if imap is not None:
+            imap.counts.clear()
 
     def cursor(self):
         """Return a `dbapi2` complaint cursor instance.
@@ -60,11 +176,73 @@ class RelationalDatabase(IDatabase):
             self.connect()
         return self.connection.cursor()
 
+    def stream_cursor(self):
+        """Return a cursor to be used to stream large result sets. Subclasses
+        should override this method if the dbapi2 driver buffers the complete
+        result set in the client memory with regular cursors.
+
+        The cursor should be kept open when the transaction is committed, else
+        the subclass should call :meth:`buffer_streams` before committing.
+        """
+        return self.cursor()
+
+    def buffer_streams(self):
+        """Fetch the remaining rows of the open streams of :meth:`iterate`
+        into the memory, so that their cursors can be closed.
+        """
+        for stream in self.streams:
+            stream.buffer()
+
     def fix_quote(self, sql):
         """Subclass should override this method to fix quotation marks.
         """
         return sql
 
+    def prepare(self, sql):
+        """Prepare the given sql statement for the execution, by fixing the
+        quotation marks and converting parameter style if required. Subclass
+        should override this method if the cursor expects different form of
+        statement then the one returned by :meth:`fix_quote`.
+        """
+        return self.fix_quote(sql)
+
+    def compile(self, qset, what, limit=None, offset=None, order=True):
+        """Compile the select statement for the given query set.
+
+        The compiled statements are cached by the shape of the query (see
+        :meth:`QueryBuilder.shape`), so the repeated queries only build the
+        list of parameters.
+
+        If `what` is None, the statement counting the matched records (or the
+        groups of a grouped query set) is compiled, see :meth:`QueryBuilder.count`.
+
+        :returns: a tuple `(sql, params)`
+        """
+        return self._compile(qset, what, limit, offset, order)[:2]
+
+    def _compile(self, qset, what, limit=None, offset=None, order=True):
+        """Same as :meth:`compile` but also returns the names of the temporary
+        tables of the lists staged by :meth:`stage_lists`, as the values of
+        those lists are not in the parameters.
+
+        :returns: a tuple `(sql, params, tables)`
+        """
+        qset, tables = self.stage_lists(qset)
+        builder = self.query_builder(qset)
+        key = (builder.shape(), what, limit > -1, offset > -1, order)
+        try:
+            return self.statements[key], builder.params(limit, offset), tables
+        except KeyError:
+            pass
+        if what is None:
+            sql, params = builder.count()
+        else:
+            sql, params = builder.select(what, limit, offset, order)
+        if len(self.statements) >= self.max_statements:
+            self.statements.clear()
+        sql = self.statements[key] = self.prepare(sql)
+        return sql, params, tables
+
     def get_field_sql(self, field, for_alter=False):
         res = '"%s" %s' % (field.name, self.get_data_type(field))
         if not for_alter:
@@ -103,13 +281,95 @@ class RelationalDatabase(IDatabase):
         output = 'CREATE TABLE "%s" (\n    %s\n);' % (model._meta.table, output)
         return self.fix_quote(output)
 
+    #: maximum length of the index names
+    max_name_length = 63
+
+    def get_indexes(self, model):
+        """Returns the list of :class:`Index` to be created for the given model,
+        the indexes declared with ``__indexes__`` and single column indexes for
+        the indexed fields and foreign keys, unless they are already covered
+        by an unique constraint or a declared index.
+        """
+        table = model._meta.table
+        result = list(model._meta.indexes)
+
+        covered = [[f.name for f in item] for item in model._meta.unique]
+        covered.extend([[n for n, h in index.columns] for index in result \
+                        if not index.where])
+
+        for field in model.fields().values():
+            if field._data_type is None or field.name == 'key':
+                continue
+            if not (field.is_indexed or isinstance(field, ManyToOne)):
+                continue
+            if [c for c in covered if c[0] == field.name]:
+                continue
+            covered.append([field.name])
+            result.append(Index(field.name))
+
+        # name the copies, the declared indexes are shared by the engines
+        used = set([index.name for index in result if index.name])
+        for i, index in enumerate(result):
+            if not index.name:
+                name = '_'.join([n for n, h in index.columns])
+                if index.unique:
+                    name = '%s_uniq' % name
+                if index.where:
+                    name = '%s_%s' % (name, md5(index.where).hexdigest()[:8])
+                name = '%s_%s_idx' % (table, name)
+                if len(name) > self.max_name_length or name in used:
+                    digest = md5('%s %s' % (name, index.fields)).hexdigest()[:8]
+                    name = '%s_%s_idx' % (table[:self.max_name_length - 13], digest)
+                used.add(name)
+                index = result[i] = copy(index)
+                index.name = name
+        return result
+
+    def get_index_sql(self, model, index):
+        """Returns the sql statement to create the given index.
+
+        :param model: a subclass of :class:`Model`
+        :param index: an instance of :class:`Index`
+        """
+        sql = 'CREATE %sINDEX "%s" ON "%s" (%s)' % (
+            'UNIQUE ' if index.unique else '', index.name, model._meta.table,
+            ", ".join(['"%s" %s' % c for c in index.columns]))
+        if index.where:
+            sql = '%s WHERE %s' % (sql, index.where)
+        return self.fix_quote('%s;' % sql)
+
+    def drop_index(self, model, name):
+        """Drop the index of the given model.
+
+        :param model: a subclass of :class:`Model`
+        :param name: name of the index
+        """
+        cursor = self.cursor()
+        cursor.execute(self.fix_quote('DROP INDEX "%s"' % name))
+
+    def exists_index(self, model, name):
+        """Check whether the index of the given model exists or not.
+
+        :param model: a subclass of :class:`Model`
+        :param name: name of the index
+
+        :returns: True if the index exists else False
+        """
+        raise NotImplementedError
+
     def schema_table(self, model):
-        return self.get_create_sql(model)
+        return "\n".join([self.get_create_sql(model)] + \
+            [self.get_index_sql(model, i) for i in self.get_indexes(model)])
 
     def create_table(self, model):
+        cursor = self.cursor()
         if not self.exists_table(model):
-            cursor = self.cursor()
             cursor.execute(self.get_create_sql(model))
+        # create missing indexes, the existing tables might be created
+        # before the indexes were declared
+        for index in self.get_indexes(model):
+            if not self.exists_index(model, index.name):
+                cursor.execute(self.get_index_sql(model, index))
 
     def drop_table(self, model):
         if self.exists_table(model):
@@ -128,42 +388,114 @@ class RelationalDatabase(IDatabase):
     def lastrowid(self, cursor, model):
         return cursor.lastrowid
 
-    def update_records(self, instance, *args):
+    def insert_rows(self, cursor, model, names, rows):
+        """Insert the given rows and return the keys of the inserted records.
+
+        The default implementation inserts the rows one by one, as the keys
+        of the records inserted by a multi-row ``INSERT`` statement can't be
+        known reliably (concurrent inserts may interleave the keys). Engines
+        which can return the keys of a multi-row ``INSERT`` statement should
+        override this method.
+
+        :param cursor: a cursor instance
+        :param model: the model class
+        :param names: the column names
+        :param rows: list of sequence of values, one for each column
+
+        :returns: list of keys of the inserted records
+        """
+        sql = 'INSERT INTO "%s" (%s) VALUES (%s)' % (
+                model._meta.table,
+                ", ".join(['"%s"' % n for n in names]),
+                ", ".join(['%s'] * len(names)))
+        sql = self.fix_quote(sql)
+        keys = []
+        for row in rows:
+            cursor.execute(sql, row)
+            keys.append(self.lastrowid(cursor, model))
+        return keys
+
+    def insert_records(self, cursor, instances, batch_size=None):
+        """Insert the given unsaved model instances. The instances are grouped
+        by model and columns to be inserted in batches of `batch_size` records
+        using :meth:`insert_rows`.
+        """
+        groups = []
+        grouped = {}
+        for obj in instances:
+            values = obj._to_database_values(True)
+            names = tuple(sorted(values))
+            group = (obj.__class__, names)
+            if group not in grouped:
+                groups.append(group)
+            grouped.setdefault(group, []).append((obj, values))
+
+        for model, names in groups:
+            items = grouped[(model, names)]
+            size = batch_size or len(items)
+            if self.max_params and names:
+                size = min(size, self.max_params // len(names))
+            for i in range(0, len(items), max(size, 1)):
+                chunk = items[i:i + size]
+                rows = [[values[n] for n in names] for obj, values in chunk]
+                keys = self.insert_rows(cursor, model, names, rows)
+                for (obj, values), key in zip(chunk, keys):
+                    obj._key = key
+                    obj.set_dirty(False)
+
+    def update_records(self, instance, *args, **kw):
 
-        result = []
         instances = [instance] + list(args)
+        batch_size = kw.get('batch_size')
 
         cursor = self.cursor()
 
+        pending = []
+        pending_ids = set()
+        updated = {}
+
         for obj in instances:
 
             assert isinstance(obj, Model), 'update_records expects Model instances'
 
+            changed = updated.setdefault(obj.__class__, [])
+
+            # insert pending records first if this instance is referencing
+            # any of them, as their keys are not known yet.
+            if pending_ids and [v for v in obj._values.values() \
+                                if id(v) in pending_ids]:
+                self.insert_records(cursor, pending, batch_size)
+                pending = []
+                pending_ids = set()
+
+            if not obj.is_saved:
+                if id(obj) not in pending_ids:
+                    pending.append(obj)
+                    pending_ids.add(id(obj))
+                continue
+
             items = obj._to_database_values(True).items()
 
             keys = [x[0] for x in items]
             vals = [x[1] for x in items]
 
-            if not obj.is_saved:
-                keys = ['"%s"' % k for k in keys]
-                sql = 'INSERT INTO "%s" (%s) VALUES (%s)' % (
-                        obj._meta.table,
-                        ", ".join(keys),
-                        ", ".join(['%s'] * len(vals)))
-                cursor.execute(self.fix_quote(sql), vals)
-                obj._key = self.lastrowid(cursor, obj.__class__)
-                result.append(obj.key)
-            else:
+            if keys:
                 keys = ", ".join(['"%s" = %%s' % k for k in keys])
                 sql = 'UPDATE "%s" SET %s WHERE "key" = %%s' % (obj._meta.table, keys)
 
                 vals.append(obj.key)
                 cursor.execute(self.fix_quote(sql), vals)
-                result.append(obj.key)
 
             obj.set_dirty(False)
+            changed.append(obj.key)
 
-        return result
+        for model, keys in updated.items():
+            self.invalidate(model, keys)
+
+        if pending:
+            self.insert_records(cursor, pending, batch_size)
+
+        return [obj.key for obj in instances]
 
     def delete_records(self, instance, *args):
 
@@ -174,11 +506,17 @@ class RelationalDatabase(IDatabase):
 
         keys = [o.key for o in instances]
 
-        sql = 'DELETE FROM "%s" WHERE "key" IN (%s)' % (
-                            instance._meta.table, ", ".join(['%s'] * len(keys)))
-
+        # delete in chunks to keep the statements small
         cursor = self.cursor()
-        cursor.execute(self.fix_quote(sql), keys)
+        for i in range(0, len(keys), self.max_in_size):
+            chunk = keys[i:i + self.max_in_size]
+            sql = 'DELETE FROM "%s" WHERE "key" IN (%s)' % (
+                instance._meta.table, ", ".join(['%s'] * len(chunk)))
+            cursor.execute(self.fix_quote(sql), chunk)
+
+        self.invalidate(instance.__class__, keys)
+        for model in cache.referencing(instance.__class__):
+            self.invalidate(model)
 
         for obj in instances:
             obj._key = None
@@ -186,26 +524,209 @@ class RelationalDatabase(IDatabase):
 
         return keys
 
+    def update_all(self, qset, values):
+        cursor = self.cursor()
+        sql, params = self.query_builder(self.stage_lists(qset)[0]).update(values)
+        cursor.execute(self.fix_quote(sql), params)
+        self.invalidate(qset.model)
+        return cursor.rowcount
+
+    def delete_all(self, qset):
+        # referenced records are taken care by the foreign key constraints
+        cursor = self.cursor()
+        sql, params = self.query_builder(self.stage_lists(qset)[0]).delete()
+        cursor.execute(self.fix_quote(sql), params)
+        self.invalidate(qset.model)
+        return cursor.rowcount
+
     def query_builder(self, qset):
         return QueryBuilder(qset)
 
-    def fetch(self, qset, limit, offset):
+    def large_lists(self, qset):
+        """Check whether the given query set (or a nested query set) has `IN`
+        lists larger than :attr:`max_in_size`.
+        """
+        for q in qset:
+            for name, op, value in q.items:
+                if isinstance(value, QSet):
+                    if self.large_lists(value):
+                        return True
+                elif isinstance(value, (list, tuple)) and \
+                        len(value) > self.max_in_size:
+                    return True
+        return False
+
+    def stage_lists(self, qset):
+        """Returns a copy of the given query set with the `IN` lists larger
+        than :attr:`max_in_size` replaced by :class:`KeyList` instances loaded
+        with :meth:`stage_list`, or the query set itself if there are none.
+
+        The temporary tables are reused by the next statements staging the
+        lists, so the result of the statement should be fetched before
+        running any other statement.
+
+        :returns: a tuple `(qset, tables)`, the names of the temporary tables
+        """
+        if not self.large_lists(qset):
+            return qset, []
+
+        qset = deepcopy(qset)
+        counter = itertools.count()
+        tables = []
+
+        def stage(qset):
+            fields = qset.model._meta.fields
+            for q in qset:
+                for i, (name, op, value) in enumerate(q.items):
+                    if isinstance(value, QSet):
+                        stage(value)
+                    elif isinstance(value, (list, tuple)) and \
+                            len(value) > self.max_in_size:
+                        field = fields[name]
+                        value = self.stage_list(field,
+                            [field.python_to_database(v) for v in value],
+                            counter.next())
+                        q.items[i] = (name, op, value)
+                        if value.table:
+                            tables.append(value.table)
+        stage(qset)
+        return qset, tables
+
+    def stage_list(self, field, values, index):
+        """Load the given values of an `IN` filter of the given field in a
+        temporary table.
+
+        :param field: the filtered field
+        :param values: the database values
+        :param index: index of the list in the statement
+
+        :returns: an instance of :class:`KeyList`
+        """
+        if field.data_type == 'key':
+            data_type = self.data_types['reference']
+        else:
+            data_type = self.get_data_type(field)
+
+        # separate tables for each type as the column type is fixed
+        table = 'kalapy_in_%d_%s' % (index, md5(data_type).hexdigest()[:8])
         cursor = self.cursor()
-        sql, params = self.query_builder(qset).select('*', limit, offset)
-        cursor.execute(self.fix_quote(sql), params)
-        names = [desc[0] for desc in cursor.description]
-        for row in cursor.fetchall():
-            yield dict([(name, row[i]) for i, name in enumerate(names)])
+        cursor.execute(self.fix_quote(
+            'CREATE TEMPORARY TABLE IF NOT EXISTS "%s" ("value" %s)' % (
+                table, data_type)))
+        cursor.execute(self.fix_quote('DELETE FROM "%s"' % table))
+        cursor.executemany(
+            self.fix_quote('INSERT INTO "%s" ("value") VALUES (%%s)' % table),
+            [(value,) for value in values])
+
+        result = KeyList(values)
+        result.table = table
+        return result
+
+    def columns(self, qset):
+        """Returns the columns to be selected for the given query set.
+        """
+        names = qset.fields
+        if not names and qset.deferred:
+            names = [f.name for f in qset.model.fields().values() \
+                     if f._data_type is not None and f.name not in qset.deferred]
+        if names:
+            return ", ".join(['"%s"' % name for name in names])
+        return '*'
+
+    def fetch(self, qset, limit, offset):
+        sql, params, tables = self._compile(qset, self.columns(qset), limit, offset)
+
+        def fetch():
+            cursor = self.cursor()
+            cursor.execute(sql, params)
+            names = [desc[0] for desc in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+        if qset.cache is not None and not tables:
+            return cache.get_result(qset.models(), (sql, params), qset.cache, fetch)
+        return fetch()
+
+    def iterate(self, qset, batch_size):
+        sql, params, tables = self._compile(qset, self.columns(qset))
+        if tables:
+            # the temporary tables may be reloaded by the statements run while
+            # iterating, so fetch all the rows before
+            cursor = self.cursor()
+            cursor.execute(sql, params)
+            names = [desc[0] for desc in cursor.description]
+            rows = cursor.fetchall()
+            for i in range(0, len(rows), batch_size):
+                yield [dict(zip(names, row)) for row in rows[i:i + batch_size]]
+            return
+        cursor = Stream(self, self.stream_cursor())
+        try:
+            cursor.execute(sql, params)
+            names = None
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                if names is None:
+                    names = [desc[0] for desc in cursor.description]
+                yield [dict(zip(names, row)) for row in rows]
+        finally:
+            cursor.close()
+
+    def aggregate(self, qset, aggregates, limit=-1, offset=0):
+        columns = ['"%s"' % name for name in qset.group or ()]
+        columns.extend(['%s(%s) AS "%s"' % (agg.function,
+                        '"%s"' % agg.name if agg.name else '*', name) \
+                        for name, agg in aggregates])
+        sql, params, tables = self._compile(qset, ", ".join(columns), limit,
+                                            offset, order=bool(qset.group))
+
+        def fetch():
+            cursor = self.cursor()
+            cursor.execute(sql, params)
+            names = [desc[0] for desc in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+        if qset.cache is not None and not tables:
+            return cache.get_result(qset.models(), (sql, params), qset.cache, fetch)
+        return fetch()
 
     def count(self, qset):
+        sql, params, tables = self._compile(qset, None, order=False)
+
+        # identical counts are computed once in the unit of work of the active
+        # identity map, the values of the lists staged in temporary tables
+        # are not in the params so they are always counted
+        key = None
+        imap = IdentityMap.current()
+        if imap is not None and not tables:
+            key = (sql, tuple([tuple(p) if isinstance(p, list) else p \
+                               for p in params]))
+            try:
+                return imap.counts[key]
+            except KeyError:
+                pass
+
+        def count():
+            cursor = self.cursor()
+            cursor.execute(sql, params)
+            try:
+                return cursor.fetchone()[0]
+            except:
+                return 0
+
+        if qset.cache is not None and not tables:
+            result = cache.get_result(qset.models(), (sql, params), qset.cache, count)
+        else:
+            result = count()
+        if key is not None:
+            imap.counts[key] = result
+        return result
+
+    def exists(self, qset):
+        sql, params = self.compile(qset, '1', 1, order=False)
         cursor = self.cursor()
-        sql, params = self.query_builder(qset).select('count("key")')
-        sql = re.sub(' ORDER BY "\w+" (ASC|DESC)', '', sql)
-        cursor.execute(self.fix_quote(sql), params)
-        try:
-            return cursor.fetchone()[0]
-        except:
-            return 0
+        cursor.execute(sql, params)
+        return cursor.fetchone() is not None
 
 
 class QueryBuilder(object):
@@ -224,56 +745,240 @@ class QueryBuilder(object):
         'not in': 'not_in',
     }
 
+    #: whether the database sorts the NULL values before the others in the
+    #: ascending order, required to seek the records by nullable columns
+    nulls_first = True
+
     def __init__(self, qset):
         self.qset = qset
         self.model = qset.model
         self.order = None
-        self.all = []
+        self.seek = qset.seek
+
+        #: additional sql conditions of the where clause
+        self.conditions = []
+
+        # the key is used as tie-breaker of the keyset queries only, so that
+        # the indexes can still cover the ordering of the others
+        columns = list(qset.order or ())
+        if not qset.group and (self.seek or qset.keyset):
+            columns = qset.seek_columns()
+        if self.seek and self.seek[0] == 'before':
+            flip = {'ASC': 'DESC', 'DESC': 'ASC'}
+            columns = [(name, flip[how]) for name, how in columns]
+
+        if columns:
+            self.order = "ORDER BY %s" % ", ".join(
+                ['"%s" %s' % c for c in columns])
+
+    def shape(self):
+        """Returns the shape of the query, a hashable value which is same for
+        all the queries resulting same statement (the model, filter fields,
+        operators, size of the `IN` lists, the ordering and the grouping).
+        """
+        items = []
+        for q in self.qset:
+            items.append(tuple([(name, op, self.value_shape(value)) \
+                                for name, op, value in q.items]))
+        seek = self.seek and (self.seek[0],
+                              tuple([v is None for v in self.seek[1]]))
+        group = self.qset.group and tuple(self.qset.group)
+        return (self.__class__, self.model._meta.table, self.qset.order,
+                self.qset.keyset, tuple(items), seek, group)
+
+    def value_shape(self, value):
+        if isinstance(value, KeyList):
+            return ('list', value.table, value.index)
+        if isinstance(value, QSet):
+            return (tuple(value.fields), self.__class__(value).shape())
+        if isinstance(value, (list, tuple)):
+            return len(value)
+        return None
+
+    def select(self, what, limit=None, offset=None, order=True):
+        """Build the select query. The `limit` and `offset` are passed as
+        parameters so that the statement can be reused.
+        """
+        query = "SELECT %s FROM \"%s\"" % (what, self.model._meta.table)
+        where, params = self.where()
+        if where:
+            query = "%s WHERE %s" % (query, where)
+        if self.qset.group:
+            query = "%s GROUP BY %s" % (query, ", ".join(
+                ['"%s"' % name for name in self.qset.group]))
+        if self.order and order:
+            query = "%s %s" % (query, self.order)
+        params.extend(self.limit_params(limit, offset))
+        if limit > -1:
+            query = "%s LIMIT %%s" % query
+            if offset > -1:
+                query = "%s OFFSET %%s" % query
 
-        try:
-            self.order = "ORDER BY \"%s\" %s" % tuple(qset.order)
-        except:
-            pass
+        return query, params
 
-        for q in qset:
-            if len(q.items) > 1:
-                statements = []
-                params = []
-                for item in q.items:
-                    name, op, val = item
-                    s, p = self.parse(name, op, val)
-                    statements.append(s)
-                    if isinstance(p, (list, tuple)):
-                        params.extend(p)
-                    else:
-                        params.append(p)
-                self.all.append((" OR ".join(statements), params))
-            else:
-                name, op, val = q.items[0]
-                self.all.append(self.parse(name, op, val))
+    def count(self):
+        """Build the query counting the matched records, or the groups if the
+        query set is grouped.
+        """
+        if not self.qset.group:
+            return self.select('count("key")', order=False)
+        sql, params = self.select(", ".join(
+            ['"%s"' % name for name in self.qset.group]), order=False)
+        return 'SELECT count(*) FROM (%s) AS "groups"' % sql, params
+
+    def params(self, limit=None, offset=None):
+        """Returns the parameters of the select query without building it.
+        """
+        params = []
+        fields = self.model._meta.fields
+        for q in self.qset:
+            for name, op, value in q.items:
+                if isinstance(value, QSet):
+                    params.extend(self.__class__(value).params())
+                    continue
+                if isinstance(value, KeyList):
+                    params.extend(self.key_list_params(value))
+                    continue
+                value = self.validator(op)(fields[name], value)
+                if isinstance(value, (list, tuple)):
+                    params.extend(value)
+                else:
+                    params.append(value)
+        if self.seek:
+            params.extend(self.seek_params())
+        params.extend(self.limit_params(limit, offset))
+        return params
+
+    def seek_params(self):
+        """Returns the parameters of the clause built by :meth:`seek_clause`.
+        """
+        return self.seek_clause()[1]
+
+    def seek_clause(self):
+        """Build the clause to seek the records after (or before) the values
+        of the seek columns, for example for columns `a` and `key`:
+
+            ("a" > %s) OR ("a" = %s AND "key" > %s)
 
-    def select(self, what, limit=None, offset=None):
-        """Build the select query.
+        The NULL values are compared with ``IS NULL`` and ``IS NOT NULL``
+        as per the sort order of the NULL values (see :attr:`nulls_first`).
+
+        :returns: a tuple `(str, params)`
         """
-        query = "SELECT %s FROM \"%s\"" % (what, self.model._meta.table)
-        if self.all:
-            query = "%s WHERE %s" % (query, " AND ".join(["(%s)" % s for s, b in self.all]))
-        if self.order:
-            query = "%s %s" % (query, self.order)
+        kind = self.seek[0]
+        fields = self.model._meta.fields
+        columns = self.qset.seek_columns()
+        values = [fields[name].python_to_database(value) for (name, how), value \
+                  in zip(columns, self.seek[1])]
+        clauses = []
+        params = []
+        for i, (name, how) in enumerate(columns):
+            greater = (how == 'ASC') == (kind == 'after')
+            value = values[i]
+            nullable = name != 'key' and not fields[name].is_required
+            if value is None:
+                # nothing is beyond the NULL values at the end
+                if greater != self.nulls_first:
+                    continue
+                last = '"%s" IS NOT NULL' % name
+            else:
+                last = '"%s" %s %%s' % (name, '>' if greater else '<')
+                if nullable and greater != self.nulls_first:
+                    last = '("%s" IS NULL OR %s)' % (name, last)
+            items = []
+            for n, v in zip([n for n, h in columns[:i]], values[:i]):
+                if v is None:
+                    items.append('"%s" IS NULL' % n)
+                else:
+                    items.append('"%s" = %%s' % n)
+                    params.append(v)
+            items.append(last)
+            if value is not None:
+                params.append(value)
+            clauses.append("(%s)" % " AND ".join(items))
+        return " OR ".join(clauses), params
+
+    def limit_params(self, limit, offset):
         if limit > -1:
-            query = "%s LIMIT %d" % (query, limit)
             if offset > -1:
-                query = "%s OFFSET %d" % (query, offset)
+                return [limit, offset]
+            return [limit]
+        return []
 
+    def update(self, values):
+        """Build the update query.
+
+        :param values: mapping of field name and value or :class:`Expr`
+        """
+        items = []
         params = []
-        for q, v in self.all:
-            if isinstance(v, (list, tuple)):
-                params.extend(v)
+        for name, value in values.items():
+            if isinstance(value, Expr):
+                s, p = self.expression(value)
             else:
-                params.append(v)
+                field = self.model._meta.fields[name]
+                s, p = '%s', [field.python_to_database(value)]
+            items.append('"%s" = %s' % (name, s))
+            params.extend(p)
 
+        query = "UPDATE \"%s\" SET %s" % (self.model._meta.table, ", ".join(items))
+        where, p = self.where()
+        if where:
+            query = "%s WHERE %s" % (query, where)
+        params.extend(p)
+
+        return query, params
+
+    def delete(self):
+        """Build the delete query.
+        """
+        query = "DELETE FROM \"%s\"" % (self.model._meta.table)
+        where, params = self.where()
+        if where:
+            query = "%s WHERE %s" % (query, where)
         return query, params
 
+    def where(self):
+        """Build the where clause.
+
+        :returns: a tuple `(str, params)`
+        """
+        statements = []
+        params = []
+        for q in self.qset:
+            items = []
+            for name, op, val in q.items:
+                s, p = self.parse(name, op, val)
+                items.append(s)
+                if isinstance(p, (list, tuple)):
+                    params.extend(p)
+                else:
+                    params.append(p)
+            statements.append("(%s)" % " OR ".join(items))
+        if self.seek:
+            clause, p = self.seek_clause()
+            statements.append("(%s)" % clause)
+            params.extend(p)
+        statements.extend(["(%s)" % c for c in self.conditions])
+        return " AND ".join(statements), params
+
+    def expression(self, expr):
+        """Build the sql expression for the given :class:`Expr`.
+
+        :returns: a tuple `(str, params)`
+        """
+        result = []
+        params = []
+        for kind, value in expr.items:
+            if kind == 'field':
+                result.append('"%s"' % value)
+            elif kind == 'value':
+                result.append('%s')
+                params.append(value)
+            else:
+                result.append(value)
+        return "(%s)" % " ".join(result), params
+
     def parse(self, name, operator, value):
         """Parse the simple query statement.
 
@@ -289,12 +994,48 @@ class QueryBuilder(object):
         op = operator.lower()
         op = self.op_alias.get(op, op)
 
+        if isinstance(value, QSet):
+            return self.subquery(name, op, value)
+        if isinstance(value, KeyList):
+            return self.key_list(name, op, value), self.key_list_params(value)
+
         handler = getattr(self, 'handle_%s' % op)
-        validator = getattr(self, 'validate_%s' % op, self.validate)
-        value = validator(field, value)
+        value = self.validator(operator)(field, value)
 
         return handler(name, value), value
 
+    def subquery(self, name, op, qset):
+        """Build the ``IN`` or ``NOT IN`` clause with a nested select query
+        of the given query set. The NULL values are not selected for the
+        ``NOT IN`` clause, which would be false for all the records otherwise.
+
+        :returns: a tuple `(str, params)`
+        """
+        builder = self.__class__(qset)
+        if op == 'not_in':
+            builder.conditions.append('"%s" IS NOT NULL' % qset.fields[0])
+        sql, params = builder.select('"%s"' % qset.fields[0], order=False)
+        return '"%s" %s (%s)' % (
+            name, 'NOT IN' if op == 'not_in' else 'IN', sql), params
+
+    def key_list(self, name, op, value):
+        """Build the ``IN`` or ``NOT IN`` clause of a :class:`KeyList`.
+        """
+        return '"%s" %s (SELECT "value" FROM "%s")' % (
+            name, 'NOT IN' if op == 'not_in' else 'IN', value.table)
+
+    def key_list_params(self, value):
+        """Returns the parameters of the clause built by :meth:`key_list`.
+        """
+        return []
+
+    def validator(self, operator):
+        """Returns the validator method for the given operator.
+        """
+        op = operator.lower()
+        op = self.op_alias.get(op, op)
+        return getattr(self, 'validate_%s' % op, self.validate)
+
     def validate(self, field, value):
         return field.python_to_database(value)
 
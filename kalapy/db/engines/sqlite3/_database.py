@@ -11,7 +11,7 @@ import os, decimal
 import sqlite3 as dbapi
 
 from kalapy.db.engines import utils
-from kalapy.db.engines.relational import RelationalDatabase
+from kalapy.db.engines.relational import RelationalDatabase, QueryBuilder, KeyList
 
 
 dbapi.register_converter('bool', lambda s: s == '1')
@@ -43,6 +43,8 @@ class Database(RelationalDatabase):
         "binary"    :   "BLOB",
     }
 
+    max_params = 999
+
     def connect(self):
         if self.connection is not None:
             return self
@@ -52,7 +54,16 @@ class Database(RelationalDatabase):
                 raise DatabaseError(
                     _("Database %(name)r doesn't exist.", name=self.name))
 
-        self.connection = dbapi.connect(self.name, detect_types=dbapi.PARSE_DECLTYPES)
+        # pooled connections might be used by different threads, but never
+        # by two threads at the same time
+        self.connection = dbapi.connect(self.name,
+            detect_types=dbapi.PARSE_DECLTYPES, check_same_thread=False)
+        # foreign key constraints (and so cascade rules) are disabled by default
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        # the sqlite3 module commits the pending transaction before a CREATE
+        # statement, so the table of the staged lists is created beforehand
+        self.connection.execute(
+            'CREATE TEMPORARY TABLE IF NOT EXISTS "kalapy_in" ("list" INTEGER, "value")')
         return self
 
     def exists_table(self, model):
@@ -63,12 +74,46 @@ class Database(RelationalDatabase):
             """, (model._meta.table,))
         return bool(cursor.fetchone())
 
+    def exists_index(self, model, name):
+        cursor = self.cursor()
+        cursor.execute("""
+            SELECT "name" FROM sqlite_master
+                WHERE type = "index" AND name = %s;
+            """, (name,))
+        return bool(cursor.fetchone())
+
 
     def cursor(self):
         if not self.connection:
             self.connect()
         return self.connection.cursor(factory=SQLiteCursor)
 
+    def stage_list(self, field, values, index):
+        # all the lists share the table created with the connection, the
+        # values are not typed by sqlite anyway
+        cursor = self.cursor()
+        cursor.execute('DELETE FROM "kalapy_in" WHERE "list" = %s', (index,))
+        cursor.executemany(
+            'INSERT INTO "kalapy_in" ("list", "value") VALUES (%s, %s)',
+            [(index, value) for value in values])
+        result = KeyList(values)
+        result.table = 'kalapy_in'
+        result.index = index
+        return result
+
+    def query_builder(self, qset):
+        return SQLiteQueryBuilder(qset)
+
+    def prepare(self, sql):
+        return Statement(self.fix_quote(sql) % tuple("?" * sql.count('%s')))
+
+
+class SQLiteQueryBuilder(QueryBuilder):
+
+    def key_list(self, name, op, value):
+        return '"%s" %s (SELECT "value" FROM "%s" WHERE "list" = %d)' % (
+            name, 'NOT IN' if op == 'not_in' else 'IN', value.table, value.index)
+
 
 class SQLiteCursor(dbapi.Cursor):
 
@@ -81,5 +126,14 @@ class SQLiteCursor(dbapi.Cursor):
         return super(SQLiteCursor, self).executemany(query, params_list)
 
     def convert_query(self, query, num_params):
+        if isinstance(query, Statement):
+            return query
         return query % tuple("?" * num_params)
 
+
+class Statement(str):
+    """A prepared sql statement, already converted to the sqlite3 parameter
+    style.
+    """
+    pass
+
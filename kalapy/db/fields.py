@@ -90,12 +90,16 @@ class Field(object):
     def __get__(self, model_instance, model_class):
         if model_instance is None:
             return self
-        return model_instance._values.get(self.name)
+        value = model_instance._values.get(self.name)
+        if isinstance(value, Deferred):
+            value.load(self.name)
+            value = model_instance._values.get(self.name)
+        return value
 
     def __set__(self, model_instance, value):
         value = self._validate(model_instance, value)
         model_instance._values[self.name] = value
-        model_instance._dirty[self.name] = True
+        model_instance._dirty |= self._mask
 
     def python_to_database(self, value):
         """Database representation of this field value.
@@ -219,6 +223,59 @@ class Field(object):
         """
         return self._indexed
 
+    @property
+    def is_lazy(self):
+        """Whether this field is loaded lazily or not.
+        """
+        return getattr(self, '_lazy', False)
+
+
+class Deferred(object):
+    """A placeholder of the field values of the model instances which are not
+    fetched from the database. The values are loaded for all the instances
+    sharing the placeholder on first access of any of them.
+
+    :param model: the model class
+    :param names: names of the deferred fields
+    """
+
+    def __init__(self, model, names):
+        self.model = model
+        self.names = names
+        self.instances = []
+
+    def attach(self, instance, values):
+        """Mark the deferred fields of the given instance, which are not in
+        the given database values, with this placeholder.
+        """
+        for name in self.names:
+            if name not in values:
+                instance._values[name] = self
+        self.instances.append(instance)
+
+    def load(self, name):
+        """Load the values of the given field. The value of the instances
+        deleted in the mean time is None.
+        """
+        pending = []
+        for obj in self.instances:
+            if obj._values.get(name) is not self:
+                continue
+            if obj.is_saved:
+                pending.append(obj)
+            else:
+                obj._values[name] = None
+        if pending:
+            values = dict(self.model.select('key', name) \
+                                    .filter('key in', [obj.key for obj in pending]) \
+                                    .fetch(-1))
+            for obj in pending:
+                obj._values[name] = values.get(obj.key)
+
+        # release the instances without any deferred value
+        self.instances = [obj for obj in self.instances \
+                          if [n for n in self.names if obj._values.get(n) is self]]
+
 
 class AutoKey(Field):
     """AutoKey field is used to define primary key of Model classes.
@@ -289,10 +346,18 @@ class Text(Field):
             title = db.String(size=100)
             content = db.Text()
 
+    If `lazy` is True, the field values are not fetched with the other
+    fields but on first access (see :meth:`Query.defer`).
+
+    :param lazy: whether to load the field values lazily
     """
 
     _data_type = "text"
 
+    def __init__(self, *args, **kw):
+        self._lazy = kw.pop('lazy', False)
+        super(Text, self).__init__(*args, **kw)
+
     def validate(self, value):
         _validate_string(self.name, value)
         return value
@@ -608,6 +673,12 @@ class Time(DateTime):
 
 class Binary(Field):
     """Binary field stores BLOB (binary large objects) like files, images etc.
+
+    :param lazy: whether to load the field values lazily, see :class:`Text`
     """
     _data_type = "blob"
 
+    def __init__(self, *args, **kw):
+        self._lazy = kw.pop('lazy', False)
+        super(Binary, self).__init__(*args, **kw)
+
@@ -0,0 +1,145 @@
+"""
+kalapy.db.identity
+~~~~~~~~~~~~~~~~~~
+
+This module implements an identity map, which ensures that a record is loaded
+only once in a unit of work (for example, a request). The subsequent lookups
+of the same record return the already loaded model instance.
+
+The identity map is enabled for every request if ``identity_map`` option is
+set in ``settings.DATABASE_OPTIONS``. It can also be enabled explicitly using
+the ``with`` statement::
+
+    with db.IdentityMap():
+        user = User.get(key)
+        assert User.get(key) is user
+
+:copyright: (c) 2010 Amit Mendapara.
+:license: BSD, see LICENSE for more details.
+"""
+from werkzeug.local import LocalStack
+
+from kalapy.conf import settings
+from kalapy.core import signals
+
+
+__all__ = ('IdentityMap',)
+
+
+class IdentityMap(object):
+    """A mapping of (model, key) to the loaded model instances. An instance
+    of this class is active between :meth:`push` and :meth:`pop` calls or
+    within the ``with`` statement block.
+
+    The counts of the identical queries are also computed only once in the
+    unit of work, unless the records are changed in between (see ``counts``).
+    Like the loaded instances, the changes made without the model api (for
+    example, with raw sql statements) are not seen by the memoized counts.
+    """
+
+    def __init__(self):
+        self.instances = {}
+        #: the memoized counts of the query statements
+        self.counts = {}
+
+    def get(self, model, key):
+        """Get the loaded instance of the given model with the given key.
+
+        :param model: a model class
+        :param key: the key of the record
+
+        :returns: a model instance or None
+        """
+        obj = self.instances.get((model._meta.name, key))
+        if obj is not None and obj.key != key:
+            # deleted since loaded
+            del self.instances[(model._meta.name, key)]
+            return None
+        return obj
+
+    def add(self, *instances):
+        """Add the given saved model instances to the map.
+        """
+        for obj in instances:
+            if obj.is_saved:
+                self.instances[(obj._meta.name, obj.key)] = obj
+
+    def remove(self, *instances):
+        """Remove the given model instances from the map.
+        """
+        for obj in instances:
+            self.instances.pop((obj._meta.name, obj.key), None)
+
+    def evict(self, model):
+        """Remove all the instances of the given model and the models referencing
+        it from the map, used when records are updated or deleted without
+        loading them.
+
+        :param model: a model class
+        """
+        models = dict([(name, obj.__class__) for (name, key), obj \
+                        in self.instances.items()])
+        names = set([model._meta.name])
+        changed = True
+        while changed:
+            changed = False
+            for name, cls in models.items():
+                if name not in names and [m for m in cls._meta.ref_models \
+                                          if m._meta.name in names]:
+                    names.add(name)
+                    changed = True
+        for name, key in self.instances.keys():
+            if name in names:
+                del self.instances[(name, key)]
+        self.counts.clear()
+
+    def clear(self):
+        """Remove all the instances and the memoized counts from the map.
+        """
+        self.instances.clear()
+        self.counts.clear()
+
+    def push(self):
+        """Make this identity map active for the current context.
+        """
+        _identity_stack.push(self)
+
+    def pop(self):
+        """Deactivate this identity map.
+        """
+        assert _identity_stack.top is self, 'popped wrong identity map'
+        _identity_stack.pop()
+
+    def __enter__(self):
+        self.push()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.pop()
+
+    @staticmethod
+    def current():
+        """Returns the active identity map or None.
+        """
+        return _identity_stack.top
+
+
+_identity_stack = LocalStack()
+
+
+@signals.connect('request-started')
+def push_identity_map():
+    """Activate a new identity map for the request if enabled.
+    """
+    if settings.DATABASE_OPTIONS.get('identity_map'):
+        IdentityMap().push()
+
+
+@signals.connect('request-finished')
+def pop_identity_map():
+    """Deactivate the identity map of the request.
+    """
+    if settings.DATABASE_OPTIONS.get('identity_map'):
+        imap = _identity_stack.top
+        if imap is not None:
+            imap.pop()
@@ -11,12 +11,14 @@ and get_models functions.
 import sys, types
 
 from kalapy.core.pool import pool
-from kalapy.db.fields import Field, AutoKey, FieldError
+from kalapy.db import cache
+from kalapy.db.fields import Field, AutoKey, FieldError, Deferred
+from kalapy.db.identity import IdentityMap
 from kalapy.db.query import Query
 from kalapy.utils.containers import OrderedDict
 
 
-__all__ = ('Model', 'get_model', 'get_models')
+__all__ = ('Model', 'Index', 'get_model', 'get_models')
 
 
 get_model = pool.get_model
@@ -33,6 +35,10 @@ class Options(object):
         self.virtual_fields = OrderedDict()
         self.ref_models = []
         self.unique = []
+        self.indexes = []
+        self.cache = None
+        self.codecs = {}
+        self.masks = {}
 
     @property
     def model(self):
@@ -45,6 +51,49 @@ class Options(object):
         super(Options, self).__setattr__(name, value)
 
 
+class Index(object):
+    """Declares an index of a model, to be listed in the ``__indexes__``
+    attribute of the model class. A field name prefixed with `-` is indexed
+    in descending order. For example::
+
+        class Revision(db.Model):
+            page = db.ManyToOne(Page)
+            timestamp = db.DateTime()
+            deleted = db.Boolean()
+
+            __indexes__ = [
+                ('page', '-timestamp'),
+                db.Index('timestamp', where='"deleted" = 0'),
+            ]
+
+    A tuple of field names is same as an :class:`Index` with those fields.
+
+    :param fields: the field names
+    :param name: name of the index, generated from table and field names if
+                 not given
+    :param unique: whether to create an unique index
+    :param where: an sql condition to create partial index, if supported
+                  by the database engine
+    """
+
+    def __init__(self, *fields, **kw):
+        assert fields, 'no fields given'
+        self.fields = list(fields)
+        self.name = kw.get('name')
+        self.unique = kw.get('unique', False)
+        self.where = kw.get('where')
+
+    @property
+    def columns(self):
+        """List of `(name, direction)` of the indexed fields.
+        """
+        return [(f[1:], 'DESC') if f.startswith('-') else (f, 'ASC') \
+                for f in self.fields]
+
+    def __repr__(self):
+        return "<Index %s>" % ", ".join(self.fields)
+
+
 RESERVED_NAMES = {
     '_meta'     : '%r is reserved for internal use.',
     '__new__'   : '%r should not be overriden.',
@@ -98,12 +147,19 @@ class ModelType(type):
                     bases[i] = parent
             bases = tuple(bases)
 
+        # no per-class __dict__ slot, the instances share the slots of Model
+        # class which allocate the __dict__ only when other attributes are set
         cls = super_new(cls, name, bases, {
             '_meta': meta,
-            '__module__': attrs.pop('__module__')})
+            '__module__': attrs.pop('__module__'),
+            '__slots__': attrs.pop('__slots__', ())})
 
         # update meta information
         unique = attrs.pop('__unique__', [])
+        indexes = attrs.pop('__indexes__', [])
+        cache = attrs.pop('__cache__', None)
+        if cache and meta.cache is None:
+            meta.cache = cache
         if meta.name is None:
             meta_name = name.lower()
             if meta.package:
@@ -117,8 +173,7 @@ class ModelType(type):
 
         # overwrite model class in the pool
         pool.register_model(cls)
-
-        cls._values = None
+        meta.codecs.clear()
 
         # sort fields and set attributes to class
         attributes = attrs.items()
@@ -153,6 +208,18 @@ class ModelType(type):
                 assert isinstance(field, Field), 'expected a field'
             meta.unique.append(item)
 
+        # prepare indexes
+        for item in indexes:
+            if not isinstance(item, Index):
+                if isinstance(item, basestring):
+                    item = [item]
+                item = Index(*item)
+            for name, how in item.columns:
+                if not isinstance(getattr(cls, name, None), Field):
+                    raise AttributeError(
+                        _('No such field %(name)s.', name=name))
+            meta.indexes.append(item)
+
         return cls
 
     def add_field(cls, field, name=None):
@@ -174,12 +241,96 @@ class ModelType(type):
         else:
             cls._meta.fields[name] = field
 
+        # bit of the field in the dirty mask of the instances
+        field._mask = cls._meta.masks[name] = 1 << len(cls._meta.masks)
+
+        # the row loaders and dumpers are generated again
+        cls._meta.codecs.clear()
+
         field.__configure__(cls, name)
 
     def __repr__(cls):
         return "<Model %r: class %s>" % (cls._meta.name, cls.__name__)
 
 
+def _overrides(field, name):
+    """Check whether the given field overrides the given method of the base
+    :class:`Field` class.
+    """
+    return getattr(field.__class__, name).im_func is not \
+           getattr(Field, name).im_func
+
+
+def _compile(name, source, namespace):
+    """Compile the given python source of a function and return the function
+    of the given name.
+    """
+    exec(compile(source, '<%s>' % name, 'exec'), namespace)
+    return namespace[name]
+
+
+def _make_loader(model, fields, names):
+    """Generate a function which creates an instance of the given model from
+    a row having the given column names, with the field converters inlined.
+
+    The database engines return the rows as mappings of column name and
+    value, so the generated function looks up the values by name. It saves
+    the calls of :meth:`Model.__init__` and of the field converters which
+    don't change the database values, not the mapping built for each row.
+    """
+    namespace = {'new': object.__new__, 'model': model}
+    values = []
+    for i, name in enumerate(names):
+        if name in ('key', '_payload'):
+            continue
+        field = fields[name]
+        if _overrides(field, 'database_to_python'):
+            namespace['conv%d' % i] = field.database_to_python
+            values.append('%r: conv%d(row[%r])' % (name, i, name))
+        else:
+            values.append('%r: row[%r]' % (name, name))
+
+    source = '\n'.join([
+        'def load(row):',
+        '    obj = new(model)',
+        '    obj._key = %s' % ("row['key']" if 'key' in names else 'None'),
+        '    obj._payload = %s' % (
+            "row['_payload']" if '_payload' in names else 'None'),
+        '    obj._values = {%s}' % ', '.join(values),
+        '    obj._dirty = 0',
+        '    return obj',
+    ])
+    return _compile('load', source, namespace)
+
+
+def _make_dumper(fields):
+    """Generate a function which returns the database values of the given
+    fields from the values of an instance, with the field converters inlined.
+    The function accepts the instance values, the dirty mask (all the fields
+    if None) and the type convertors.
+    """
+    namespace = {'Deferred': Deferred}
+    lines = ['def dump(values, dirty, conv):',
+             '    result = {}']
+    for i, field in enumerate(fields.values()):
+        name = field.name
+        if name == 'key':
+            continue
+        lines.extend([
+            '    if dirty is None or dirty & %d:' % field._mask,
+            '        value = values.get(%r)' % name,
+            '        if value.__class__ is not Deferred:'])
+        if _overrides(field, 'python_to_database'):
+            namespace['conv%d' % i] = field.python_to_database
+            lines.append('            value = conv%d(value)' % i)
+        lines.extend([
+            '            if conv and %r in conv:' % field.data_type,
+            '                value = conv[%r](value)' % field.data_type,
+            '            result[%r] = value' % name])
+    lines.append('    return result')
+    return _compile('dump', '\n'.join(lines), namespace)
+
+
 class Model(object):
     """Model is the super class of all the objects of data entities in
     the database.
@@ -282,6 +433,10 @@ class Model(object):
     >>> u = User(name="some")
     >>> u.save()
 
+    The state of the model instances is kept in `__slots__`, and the
+    `__dict__` is only allocated when other attributes are set on them, which
+    keeps the instances small for large results.
+
     `key`
 
         Represents the key field for the data model (primary key).
@@ -291,6 +446,8 @@ class Model(object):
 
     __metaclass__ = ModelType
 
+    __slots__ = ('_key', '_payload', '_values', '_dirty', '__dict__', '__weakref__')
+
     def __new__(cls, **kw):
         if cls is Model:
             raise TypeError(_("You can't create instance of Model class"))
@@ -310,8 +467,8 @@ class Model(object):
         #: stores record values
         self._values = {}
 
-        #: stores dirty information
-        self._dirty = {}
+        #: stores dirty information, a bitmask of the dirty fields
+        self._dirty = 0
 
         for field in self.fields().values():
             if field.name in kw and not field.empty(kw[field.name]):
@@ -335,14 +492,27 @@ class Model(object):
 
         :returns: True if dirty, else False
         """
-        return not self.is_saved or self._dirty
+        return not self.is_saved or bool(self._dirty)
 
     def set_dirty(self, dirty=True):
         """Set the instance as dirty or clean.
 
         :param dirty: if True set dirty else set clean
         """
-        self._dirty = dict.fromkeys(self._values, True) if dirty else {}
+        mask = 0
+        if dirty:
+            masks = self._meta.masks
+            for name in self._values:
+                mask |= masks[name]
+        self._dirty = mask
+
+    def __getstate__(self):
+        return (self._key, self._payload, self._values, self._dirty,
+                self.__dict__)
+
+    def __setstate__(self, state):
+        self._key, self._payload, self._values, self._dirty, attrs = state
+        self.__dict__.update(attrs)
 
     def _to_database_values(self, dirty=False, conv=None):
         """Return values to be stored in database table for this model instance.
@@ -358,41 +528,81 @@ class Model(object):
 
         :returns: a dict, key-value maping of this model's fields.
         """
-        fields = self.fields().values()
-        if dirty:
-            fields = [f for f in fields if f.name in self._dirty]
-
-        result = {}
-        for field in fields:
-            if field.name == 'key': continue
-            value = field.python_to_database(self._values[field.name])
-            if conv and field.data_type in conv:
-                value = conv[field.data_type](value)
-            result[field.name] = value
-        return result
+        try:
+            dump = self._meta.codecs[None]
+        except KeyError:
+            dump = self._meta.codecs[None] = _make_dumper(self._meta.fields)
+        return dump(self._values, self._dirty if dirty else None, conv)
 
     @classmethod
-    def _from_database_values(cls, values):
+    def _loader(cls, names):
+        """Returns a function which creates an instance of this model from
+        a row (mapping of column name and database value) having exactly
+        the given column names.
+
+        The functions are generated once for each set of column names and
+        discarded when the model is extended.
+
+        :param names: a tuple of column names
+        """
+        codecs = cls._meta.codecs
+        try:
+            return codecs[names]
+        except KeyError:
+            loader = _make_loader(pool.get_model(cls), cls._meta.fields, names)
+            return codecs.setdefault(names, loader)
+
+    @classmethod
+    def _from_database_values(cls, values, deferred=None):
         """Create an instance of this model which properties initialized with
         the given values fetched from database.
 
         :param values: mapping of name, value to instance properties
+        :param deferred: a :class:`Deferred` placeholder for the fields not
+                         fetched from the database
 
         :returns: an instance of this model
         """
-        values = dict(values)
+        return cls._from_database_rows([values], deferred)[0]
 
-        obj = cls()
-        obj._key = values.pop('key', None)
-        obj._payload = values.pop('_payload', None)
+    @classmethod
+    def _from_database_rows(cls, rows, deferred=None):
+        """Same as :meth:`_from_database_values` but create instances for all
+        the given rows, which are expected to have same column names.
 
-        fields = obj.fields()
-        for k, v in values.items():
-            values[k] = fields[k].database_to_python(v)
+        :param rows: list of mapping of name, value to instance properties
+        :param deferred: a :class:`Deferred` placeholder for the fields not
+                         fetched from the database
 
-        obj._values.update(values)
-        obj._dirty = {}
-        return obj
+        :returns: list of instances of this model
+        """
+        if not rows:
+            return []
+
+        imap = IdentityMap.current()
+        names = tuple(rows[0])
+        load = cls._loader(names)
+
+        result = []
+        for row in rows:
+            if imap is not None:
+                obj = imap.get(cls, row.get('key'))
+                if obj is not None:
+                    result.append(obj)
+                    continue
+            if len(row) == len(names):
+                try:
+                    obj = load(row)
+                except KeyError:
+                    obj = cls._loader(tuple(row))(row)
+            else:
+                obj = cls._loader(tuple(row))(row)
+            if deferred is not None:
+                deferred.attach(obj, row)
+            if imap is not None:
+                imap.add(obj)
+            result.append(obj)
+        return result
 
     def _get_related(self):
         """Get the list of all related model instances associated with this
@@ -435,8 +645,50 @@ class Model(object):
         objects = self._get_related() + [self] # first save all related records
         database.update_records(*objects)
 
+        imap = IdentityMap.current()
+        if imap is not None:
+            imap.add(*objects)
+
         return self.key
 
+    @classmethod
+    def bulk_save(cls, objects, batch_size=500):
+        """Writes all the given instances to the database in batches.
+
+        The unsaved instances are grouped by model and fields to be inserted
+        with as few statements as the database engine allows, a single
+        statement per batch if the engine can return the keys of the inserted
+        records. The dirty instances referenced by :class:`ManyToOne`
+        properties are saved first.
+
+        >>> users = [User(name='user%d' % i) for i in range(1000)]
+        >>> keys = User.bulk_save(users)
+
+        :param objects: sequence of model instances
+        :param batch_size: maximum number of records to be inserted at once
+
+        :returns: list of keys of the given instances
+        :raises: :class:`DatabaseError` if instances could not be commited.
+        """
+        objects = list(objects)
+
+        instances = []
+        seen = set()
+        for obj in [o for obj in objects for o in obj._get_related()] + objects:
+            if id(obj) not in seen and obj.is_dirty:
+                instances.append(obj)
+                seen.add(id(obj))
+
+        if instances:
+            from kalapy.db.engines import database
+            database.update_records(*instances, **{'batch_size': batch_size})
+
+            imap = IdentityMap.current()
+            if imap is not None:
+                imap.add(*instances)
+
+        return [obj.key for obj in objects]
+
     def delete(self):
         """Deletes the instance from the database.
 
@@ -450,6 +702,14 @@ class Model(object):
         database.delete_records(self)
         self._key = None
 
+        imap = IdentityMap.current()
+        if imap is not None:
+            # referencing records might have been deleted or updated as well
+            from kalapy.db.reference import OneToMany, O2ORel
+            for field in self._meta.virtual_fields.values():
+                if isinstance(field, (OneToMany, O2ORel)):
+                    imap.evict(field.reference)
+
     @classmethod
     def get(cls, keys):
         """Fetch the instance(s) from the database using the provided keys.
@@ -470,17 +730,65 @@ class Model(object):
             If `keys` is single value it will return and instance of the model
             else returns list of instances.
 
+        If an :class:`IdentityMap` is active, the instances already loaded are
+        returned without querying the database. The records of the models
+        declaring ``__cache__`` are also served from the configured cache.
+
+        The instances are returned in the order of the given `keys`, which
+        may be any number of keys (see :attr:`RelationalDatabase.max_in_size`).
+
         :raises: :class:`DatabaseError` if instances can't be retrieved.
         """
         single = False
         if not isinstance(keys, (list, tuple)):
             keys = [keys]
             single = True
-        result = cls.all().filter('key in', keys).fetch(-1)
+        requested = keys
+
+        result = []
+        imap = IdentityMap.current()
+        if imap is not None:
+            missing = []
+            seen = set()
+            for key in keys:
+                if key in seen:
+                    continue
+                seen.add(key)
+                obj = imap.get(cls, key)
+                if obj is None:
+                    missing.append(key)
+                else:
+                    result.append(obj)
+            keys = missing
+
+        lazy = [f.name for f in cls._meta.fields.values() if f.is_lazy]
+        deferred = Deferred(cls, lazy) if lazy else None
+
+        if keys and cls._meta.cache:
+            cached = cache.get_records(cls, keys)
+            if cached:
+                result.extend([cls._from_database_values(cached[k], deferred) \
+                               for k in keys if k in cached])
+                keys = [k for k in keys if k not in cached]
+
+        if keys:
+            # cache the rows as fetched, the instances may differ from them
+            rows = cls.all().filter('key in', keys)._rows(-1)
+            cache.set_records(cls, rows)
+            result.extend(cls._from_database_rows(rows, deferred))
 
         if single:
             return result[0] if result else None
-        return result
+
+        # restore the order of the requested keys
+        found = dict([(obj.key, obj) for obj in result])
+        ordered = []
+        for key in requested:
+            obj = found.pop(key, None)
+            if obj is not None:
+                ordered.append(obj)
+        ordered.extend([obj for obj in result if obj.key in found])
+        return ordered
 
     @classmethod
     def all(cls):
@@ -506,18 +814,15 @@ class Model(object):
         >>> print users
         [<Object ...> ...]
 
+        Only the given fields are fetched from the database and no model
+        instances are created. The values of the :class:`ManyToOne` fields are
+        the keys of the referenced records.
+
         :arg fields: sequence of fields
 
         :returns: an :class:`Query` instance
         """
-        def mapper(obj):
-            if not fields:
-                return obj
-            if len(fields) > 1:
-                return tuple([getattr(obj, name) for name in fields])
-            return getattr(obj, fields[0])
-
-        return Query(cls, mapper)
+        return Query(cls, fields=fields or None)
 
     @classmethod
     def fields(cls):
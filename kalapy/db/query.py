@@ -9,14 +9,26 @@ from the database.
 :license: BSD, see LICENSE for more details.
 
 """
-import re
+import re, base64, datetime, decimal
 from copy import deepcopy
 
+try:
+    import simplejson as json
+except ImportError:
+    import json
 
-__all__ = ('Query', 'Q')
+from kalapy.db.fields import Deferred
+from kalapy.db.identity import IdentityMap
+
+
+__all__ = ('Query', 'Q', 'Paginator', 'Count', 'Sum', 'Avg', 'Min', 'Max')
 
 _FILTER_REGEX = re.compile(
-    '^\s*([\w]+)\s+(>|<|>=|<=|==|!=|=|in|not in)\s*$', re.I)
+    '^\s*([\w.]+)\s+(>|<|>=|<=|==|!=|=|in|not in)\s*$', re.I)
+
+_EXPR_REGEX = re.compile('^\s*(\w+)\s*=\s*(.+?)\s*$')
+
+_EXPR_TOKEN_REGEX = re.compile('\s*(?:(\d+\.\d*|\.\d+|\d+)|(\w+)|([-+*/()]))')
 
 class Q(object):
     """Encapsulates query filters as objects that can then be used to perform
@@ -26,6 +38,16 @@ class Q(object):
 
     The ``AND`` operation is not supported as ``AND`` is the default behaviour
     of multiple :func:`Query.filter` calls.
+
+    The value of ``in`` and ``not in`` filters can be another :class:`Query`
+    selecting a single field (see :meth:`Model.select`), which is evaluated
+    by the database as a nested query::
+
+        q = Query(User).filter('key in', Article.select('author').filter(
+                'pub_date >=', yesterday))
+
+    The fields of the models referenced with :class:`ManyToOne` fields can be
+    filtered with dotted names, for example ``Q('author.name =', 'some%')``.
     """
     def __init__(self, query, value):
         try:
@@ -37,13 +59,19 @@ class Q(object):
 
     def validate(self, model):
         for i, (name, operator, value) in enumerate(self.items):
+            if '.' in name:
+                self.items[i] = self.__relation(model, name, operator, value)
+                continue
+
             if name not in model._meta.fields:
                 raise AttributeError(
                     _('No such field %(name)r in model %(model)r',
                         name=name, model=model._meta.name))
 
             field = model._meta.fields[name]
-            if operator in ('in', 'not in'):
+            if operator in ('in', 'not in') and isinstance(value, Query):
+                value = value.subquery()
+            elif operator in ('in', 'not in'):
                 assert isinstance(value, (list, tuple))
                 value = [field.python_to_database(v) for v in value]
             else:
@@ -51,6 +79,21 @@ class Q(object):
             self.items[i] = (name, operator, value)
         return self
 
+    def __relation(self, model, name, operator, value):
+        # filter on the field of a referenced model is same as filtering the
+        # referencing field with a nested query of the referenced model
+        from kalapy.db.reference import ManyToOne
+        head, rest = name.split('.', 1)
+        field = model._meta.fields.get(head)
+        if not isinstance(field, ManyToOne):
+            raise AttributeError(
+                _('No such relation field %(name)r in model %(model)r',
+                    name=head, model=model._meta.name))
+        qset = QSet(field.reference)
+        qset.fields = ['key']
+        qset.append(Q('%s %s' % (rest, operator), value))
+        return (head, 'in', qset)
+
     def __deepcopy__(self, meta):
         n, o, v = self.items[0]
         q = Q('%s %s' % (n, o), None)
@@ -68,6 +111,193 @@ class Q(object):
         return "(" + " OR ".join(map(str, self.items)) + ")"
 
 
+class Expr(object):
+    """Encapsulates an arithmetic update expression like ``views = views + 1``
+    that can be used with :meth:`Query.update` to update field values in place
+    without fetching the records.
+
+    The right hand side of the expression can use field names, numbers,
+    arithmetic operators ``+, -, *, /`` and parenthesis.
+    """
+    def __init__(self, expr):
+        try:
+            self.name, rhs = _EXPR_REGEX.match(expr).groups()
+        except:
+            raise Exception(
+                _('Malformed expression: %(expr)s', expr=expr))
+        self.items = []
+        pos = 0
+        while pos < len(rhs):
+            match = _EXPR_TOKEN_REGEX.match(rhs, pos)
+            if match is None:
+                raise Exception(
+                    _('Malformed expression: %(expr)s', expr=expr))
+            number, name, op = match.groups()
+            if number:
+                value = float(number) if '.' in number else int(number)
+                self.items.append(('value', value))
+            elif name:
+                self.items.append(('field', name))
+            else:
+                self.items.append(('op', op))
+            pos = match.end()
+
+    def validate(self, model):
+        for name in [self.name] + self.fields:
+            if name not in model._meta.fields:
+                raise AttributeError(
+                    _('No such field %(name)r in model %(model)r',
+                        name=name, model=model._meta.name))
+        if self.name == 'key':
+            raise AttributeError(
+                _('%(name)r is a read-only primary key field.', name=self.name))
+        return self
+
+    @property
+    def fields(self):
+        """List of field names used by the right hand side of the expression.
+        """
+        return [v for t, v in self.items if t == 'field']
+
+    def evaluate(self, model_instance):
+        """Evaluate the expression against the field values of the given
+        model instance. Used by engines which can't update records in place.
+        """
+        values = dict([(n, getattr(model_instance, n)) for n in self.fields])
+        source = " ".join([str(v) for t, v in self.items])
+        return eval(source, {'__builtins__': {}}, values)
+
+    def __repr__(self):
+        return "%s = %s" % (self.name, " ".join([str(v) for t, v in self.items]))
+
+
+class Aggregate(object):
+    """The base class of the aggregate functions, which can be used with
+    :meth:`Query.aggregate` and :meth:`Query.annotate` to compute a summary
+    value of the matched records in the database.
+
+    The database engines which can't compute them natively reduce the records
+    in memory with :meth:`start`, :meth:`step` and :meth:`finish` methods.
+
+    :param name: name of the field to aggregate
+    """
+
+    #: name of the sql function
+    function = None
+
+    def __init__(self, name=None):
+        self.name = name
+
+    def validate(self, model):
+        if self.name is None or self.name not in model._meta.fields:
+            raise AttributeError(
+                _('No such field %(name)r in model %(model)r',
+                    name=self.name, model=model._meta.name))
+        return self
+
+    def convert(self, model, value):
+        """Convert the database value of the aggregate to python value.
+        """
+        if value is None:
+            return value
+        return model._meta.fields[self.name].database_to_python(value)
+
+    def start(self):
+        """Returns the initial state of the in-memory reducer.
+        """
+        return None
+
+    def step(self, state, value):
+        """Returns the new state after reducing the given value.
+        """
+        raise NotImplementedError
+
+    def finish(self, state):
+        """Returns the result of the reducer from the final state.
+        """
+        return state
+
+    def __repr__(self):
+        return "%s(%s)" % (self.function, self.name or '*')
+
+
+class Count(Aggregate):
+    """Number of the records, or the records having a value of the given
+    field if given.
+    """
+    function = 'COUNT'
+
+    def validate(self, model):
+        if self.name is None:
+            return self
+        return super(Count, self).validate(model)
+
+    def convert(self, model, value):
+        return int(value or 0)
+
+    def start(self):
+        return 0
+
+    def step(self, state, value):
+        if self.name is None or value is not None:
+            state += 1
+        return state
+
+
+class Sum(Aggregate):
+    """Sum of the values of the given field.
+    """
+    function = 'SUM'
+
+    def step(self, state, value):
+        if value is None:
+            return state
+        return value if state is None else state + value
+
+
+class Avg(Aggregate):
+    """Average of the values of the given field.
+    """
+    function = 'AVG'
+
+    def convert(self, model, value):
+        return value
+
+    def start(self):
+        return (0, 0)
+
+    def step(self, state, value):
+        if value is None:
+            return state
+        return (state[0] + value, state[1] + 1)
+
+    def finish(self, state):
+        total, count = state
+        return float(total) / count if count else None
+
+
+class Min(Aggregate):
+    """Minimum value of the given field.
+    """
+    function = 'MIN'
+
+    def step(self, state, value):
+        if value is None:
+            return state
+        return value if state is None else min(state, value)
+
+
+class Max(Aggregate):
+    """Maximum value of the given field.
+    """
+    function = 'MAX'
+
+    def step(self, state, value):
+        if value is None:
+            return state
+        return value if state is None else max(state, value)
+
+
 class QSet(object):
     """A container of all the :class:`db.Q` instances of a :class:`db.Query`.
 
@@ -79,6 +309,13 @@ class QSet(object):
         self.model = model
         self.items = []
         self.order = None
+        self.cache = None
+        self.seek = None
+        self.keyset = False
+        self.fields = None
+        self.deferred = None
+        self.group = None
+        self.annotations = None
 
     def append(self, q):
         self.items.append(q.validate(self.model))
@@ -91,19 +328,126 @@ class QSet(object):
         from kalapy.db.engines import database
         return database.count(self)
 
+    def estimate(self):
+        from kalapy.db.engines import database
+        return database.estimate(self)
+
+    def exists(self):
+        from kalapy.db.engines import database
+        return database.exists(self)
+
+    def iterate(self, batch_size):
+        from kalapy.db.engines import database
+        return database.iterate(self, batch_size)
+
+    def aggregate(self, aggregates, limit=-1, offset=0):
+        from kalapy.db.engines import database
+        return database.aggregate(self, aggregates, limit, offset)
+
+    def update(self, values):
+        from kalapy.db.engines import database
+        return database.update_all(self, values)
+
+    def delete(self):
+        from kalapy.db.engines import database
+        return database.delete_all(self)
+
     def __deepcopy__(self, meta):
         qs = QSet(self.model)
         qs.order = self.order
+        qs.cache = self.cache
+        qs.seek = self.seek
+        qs.keyset = self.keyset
+        qs.fields = self.fields
+        qs.deferred = self.deferred
+        qs.group = self.group
+        qs.annotations = self.annotations
         qs.items = deepcopy(self.items, meta)
         return qs
 
+    def seek_columns(self):
+        """Returns the list of `(name, direction)` of the columns used to seek
+        the records, the ordering columns followed by the key column.
+        """
+        columns = list(self.order or ())
+        if 'key' not in [name for name, how in columns]:
+            columns.append(('key', columns[-1][1] if columns else 'ASC'))
+        return columns
+
+    def subqueries(self):
+        """Returns the list of query sets used as values of the filters.
+        """
+        return [value for q in self.items for name, op, value in q.items \
+                if isinstance(value, QSet)]
+
+    def models(self):
+        """Returns the list of models read by this query set, the model and
+        the models of the nested query sets.
+        """
+        result = [self.model]
+        for qset in self.subqueries():
+            result.extend([m for m in qset.models() if m not in result])
+        return result
+
     def __iter__(self):
         return iter(self.items)
 
     def __repr__(self):
+        if self.fields:
+            return "%s(%s: %s)" % (self.model._meta.table,
+                ", ".join(self.fields), " AND ".join(map(repr, self.items)))
         return " AND ".join(map(repr, self.items))
 
 
+def _dump_value(value):
+    if isinstance(value, datetime.datetime):
+        return {'datetime': value.strftime('%Y-%m-%dT%H:%M:%S.%f')}
+    if isinstance(value, datetime.date):
+        return {'date': value.strftime('%Y-%m-%d')}
+    if isinstance(value, datetime.time):
+        return {'time': value.strftime('%H:%M:%S.%f')}
+    if isinstance(value, decimal.Decimal):
+        return {'decimal': str(value)}
+    return value
+
+def _load_value(value):
+    if not isinstance(value, dict):
+        return value
+    kind, value = value.items()[0]
+    if kind == 'datetime':
+        return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+    if kind == 'date':
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    if kind == 'time':
+        return datetime.datetime.strptime(value, '%H:%M:%S.%f').time()
+    if kind == 'decimal':
+        return decimal.Decimal(value)
+    raise ValueError(kind)
+
+def encode_cursor(columns, values):
+    """Encode the given seek columns and values as an opaque cursor token,
+    which is safe to use in urls.
+    """
+    data = json.dumps([columns, map(_dump_value, values)])
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+def decode_cursor(columns, token):
+    """Decode the values from the given cursor token created with
+    :func:`encode_cursor` for the same seek columns.
+
+    :raises: :class:`ValueError` if the token is not valid
+    """
+    try:
+        token = str(token)
+        data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        cols, values = json.loads(data)
+        if [tuple(c) for c in cols] != list(columns):
+            raise ValueError(cols)
+        return map(_load_value, values)
+    except Exception:
+        raise ValueError(_('Invalid cursor %(token)r', token=token))
+
+
 class Query(object):
     """The `Query` class provides methods to filter and fetch records from the
     database with simple pythonic statements.
@@ -130,11 +474,18 @@ class Query(object):
     >>> print names
     ['some', 'someone', 'some1']
 
+    If `fields` are given, only those fields are fetched from the database and
+    the result contains the field values (tuples of values if more then one
+    fields) instead of model instances.
+
+    >>> names = Query(User, fields=['name']).filter('name =', 'some%').fetch(-1)
+
     :param model: a model, subclass of :class:`Model`
     :param mapper: a `callback` function to map query result
+    :param fields: names of the fields to fetch
     """
 
-    def __init__(self, model, mapper=None):
+    def __init__(self, model, mapper=None, fields=None):
         """Create a new instance of :class:`Query` for the given `model`. The result
         set will be mapped with the given mapper.
         """
@@ -144,6 +495,15 @@ class Query(object):
         self.__model = model
         self.__mapper = mapper
         self.__qset = QSet(model)
+        self.__prefetch = []
+        self.__rows = None
+
+        if fields:
+            self.__select(fields)
+
+        lazy = [f.name for f in model._meta.fields.values() if f.is_lazy]
+        if lazy:
+            self.__qset.deferred = lazy
 
     def filter(self, *args):
         """Return a new :class:`Query` instance with the given query ANDed with
@@ -178,18 +538,303 @@ class Query(object):
         query.__qset.append(q)
         return query
 
-    def order(self, spec):
-        """Order the query result with given spec.
+    def order(self, *specs):
+        """Order the query result with given specs. Multiple specs can be
+        given to order by multiple fields, the later ones are used to order
+        the records having same value of the former ones.
 
         >>> q = Query(User).filter("name =", "some%").filter("age >=", 20)
         >>> q.order("-age")
+        >>> q.order("lang", "-age")
+
+        :param specs: field names, if prefixed with `-` order by DESC else ASC
+        """
+        assert specs, 'no order spec given'
+        order = []
+        for spec in specs:
+            assert isinstance(spec, basestring)
+            if spec.startswith('-'):
+                order.append((spec[1:], 'DESC'))
+            else:
+                order.append((spec, 'ASC'))
+        self.__qset.order = tuple(order)
+        return self
 
-        :param spec: field name, if prefixed with `-` order by DESC else ASC
+    def keyset(self):
+        """Order the records by the key after the ordering columns, like the
+        queries continued with :meth:`after` and :meth:`before` do, so that the
+        records having same values of the ordering columns are returned in the
+        same order. Use it for the first page of such queries.
+
+        >>> q = Query(Revision).order('-timestamp').keyset()
+        >>> revisions = q.fetch(20)
+        >>> next_revisions = q.after(revisions[-1]).fetch(20)
+        """
+        self.__qset.keyset = True
+        return self
+
+    def group_by(self, *names):
+        """Group the matched records by the values of the given fields. The
+        result of the query is a list of dicts of the values of the grouped
+        fields and the aggregates given with :meth:`annotate`.
+
+        >>> Query(Revision).group_by('page').annotate(n=Count()).order('-n')
+        [{'page': 1, 'n': 12}, {'page': 3, 'n': 5}, ...]
+
+        The records are grouped by the database, or in memory by the engines
+        which don't support it (GAE). The query can be ordered by the grouped
+        fields and the aggregate names.
+
+        :param names: names of the fields to group by
+
+        :raises: :class:`AttributeError` if a field doesn't exist
+        """
+        assert names, 'no field given'
+        meta = self.__model._meta
+        for name in names:
+            if name not in meta.fields:
+                raise AttributeError(
+                    _('No such field %(name)r in model %(model)r',
+                        name=name, model=meta.name))
+        self.__qset.group = list(names)
+        return self
+
+    def annotate(self, **aggregates):
+        """Compute the given aggregates for each group of the records (see
+        :meth:`group_by`), or for all the matched records if not grouped.
+
+        :param aggregates: mapping of name and :class:`Aggregate`
+
+        :raises: :class:`AttributeError` if a field doesn't exist
+        """
+        assert aggregates, 'no aggregate given'
+        items = dict(self.__qset.annotations or ())
+        for name, agg in aggregates.items():
+            items[name] = agg.validate(self.__model)
+        self.__qset.annotations = sorted(items.items())
+        return self
+
+    def aggregate(self, **aggregates):
+        """Compute the given aggregates of all the matched records, without
+        fetching the records.
+
+        >>> Query(Order).filter('paid ==', True).aggregate(
+        ...     total=Sum('amount'), n=Count())
+        {'total': Decimal('1024.50'), 'n': 42}
+
+        :param aggregates: mapping of name and :class:`Aggregate`
+
+        :returns: a dict of name and value of the given aggregates
+        :raises: :class:`AttributeError` if a field doesn't exist
+        """
+        assert aggregates, 'no aggregate given'
+        items = sorted([(name, agg.validate(self.__model)) \
+                        for name, agg in aggregates.items()])
+        qset = deepcopy(self.__qset)
+        qset.group = qset.order = None
+        qset.seek = None
+        return self.__groups(qset.aggregate(items), [], items)[0]
+
+    def __groups(self, rows, group, aggregates):
+        fields = self.__model._meta.fields
+        convs = [(name, fields[name].database_to_python) for name in group]
+        convs.extend([(name, lambda v, agg=agg: agg.convert(self.__model, v)) \
+                      for name, agg in aggregates])
+        return [dict([(name, conv(row[name])) for name, conv in convs]) \
+                for row in rows]
+
+    def prefetch(self, *names):
+        """Fetch the instances related to the query result by the given
+        relation fields in batch, with one query per relation, instead of
+        fetching them for each instance separately on first access.
+
+        >>> q = Query(Revision).order('-timestamp').prefetch('page')
+        >>> for revision in q.fetch(20):
+        >>>     print revision.page.name
+
+        The related instances of :class:`OneToMany` and :class:`ManyToMany`
+        fields are available by iterating over the field value:
+
+        >>> for page in Query(Page).prefetch('revisions').fetch(20):
+        >>>     print [revision.note for revision in page.revisions]
+
+        :param names: names of relation fields of the model of this query
+
+        :raises: :class:`FieldError` if a field is not a relation field
+        """
+        meta = self.__model._meta
+        for name in names:
+            field = meta.fields.get(name) or meta.virtual_fields.get(name)
+            if not hasattr(field, 'prefetch'):
+                from kalapy.db.fields import FieldError
+                raise FieldError(
+                    _('No such relation field %(name)r in model %(model)r',
+                        name=name, model=meta.name))
+            if name not in self.__prefetch:
+                self.__prefetch.append(name)
+        return self
+
+    def __select(self, fields):
+        meta = self.__model._meta
+        for name in fields:
+            if name not in meta.fields:
+                raise AttributeError(
+                    _('No such field %(name)r in model %(model)r',
+                        name=name, model=meta.name))
+        self.__qset.fields = list(fields)
+
+    def values(self, *fields):
+        """Fetch the result as dicts of the given field names and values
+        instead of model instances. If no fields are given, all the fields
+        are fetched.
+
+        >>> Query(User).values('name', 'dob').fetch(-1)
+        [{'name': 'a', 'dob': ...}, ...]
+
+        The rows are converted directly, without creating model instances,
+        which makes it suitable for reporting and export of large results.
+
+        :param fields: names of the fields to fetch
+
+        :raises: :class:`AttributeError` if a field doesn't exist
+        """
+        self.__select(fields or self.__columns())
+        self.__rows = dict
+        return self
+
+    def tuples(self, *fields):
+        """Same as :meth:`values` but fetch the result as tuples of values
+        of the given fields, in the given order.
+
+        >>> Query(User).tuples('name', 'dob').fetch(-1)
+        [('a', ...), ...]
+
+        :param fields: names of the fields to fetch
+
+        :raises: :class:`AttributeError` if a field doesn't exist
+        """
+        self.__select(fields or self.__columns())
+        self.__rows = tuple
+        return self
+
+    def __columns(self):
+        return [name for name, field in self.__model._meta.fields.items() \
+                if field._data_type is not None]
+
+    def defer(self, *names):
+        """Don't fetch the given fields with the query, the values are fetched
+        on first access, for all the instances fetched together.
+
+        >>> for revision in Query(Revision).defer('text').fetch(20):
+        >>>     print revision.note
+
+        The fields declared with `lazy=True` are always deferred.
+
+        :param names: names of the fields to defer
+
+        :raises: :class:`FieldError` if a field can't be deferred
+        """
+        deferred = list(self.__qset.deferred or [])
+        for name in names:
+            self.__check_deferred(name)
+            if name not in deferred:
+                deferred.append(name)
+        self.__qset.deferred = deferred
+        return self
+
+    def only(self, *names):
+        """Fetch only the given fields (and the key and reference fields) with
+        the query, the other fields are deferred (see :meth:`defer`).
+
+        :param names: names of the fields to fetch
+
+        :raises: :class:`FieldError` if a field doesn't exist
+        """
+        fields = self.__model._meta.fields
+        for name in names:
+            if name not in fields:
+                self.__check_deferred(name)
+        self.__qset.deferred = [name for name in fields \
+                                if name not in names and self.__can_defer(name)]
+        return self
+
+    def __can_defer(self, name):
+        from kalapy.db.reference import IRelation
+        field = self.__model._meta.fields.get(name)
+        return name != 'key' and field is not None \
+                             and field._data_type is not None \
+                             and not isinstance(field, IRelation)
+
+    def __check_deferred(self, name):
+        if not self.__can_defer(name):
+            from kalapy.db.fields import FieldError
+            raise FieldError(
+                _('Field %(name)r of model %(model)r can not be deferred',
+                    name=name, model=self.__model._meta.name))
+
+    def after(self, value):
+        """Continue the query after the given record, with respect to the
+        ordering of the query and then the key (keyset pagination). Unlike
+        the `offset` of :meth:`fetch` the database doesn't have to scan and
+        discard all the previous records.
+
+        >>> q = Query(Revision).order('-timestamp').keyset()
+        >>> revisions = q.fetch(20)
+        >>> next_revisions = q.after(revisions[-1]).fetch(20)
+
+        :param value: a model instance or a cursor token returned by
+                      :meth:`cursor`
+
+        :raises: :class:`ValueError` if the cursor token is not valid
+        """
+        self.__qset.seek = ('after', self.__seek_values(value))
+        return self
+
+    def before(self, value):
+        """Same as :meth:`after` but continue the query before the given record.
+        The result of :meth:`fetch` is still ordered as per the query ordering.
+
+        :param value: a model instance or a cursor token returned by
+                      :meth:`cursor`
+
+        :raises: :class:`ValueError` if the cursor token is not valid
+        """
+        self.__qset.seek = ('before', self.__seek_values(value))
+        return self
+
+    def cursor(self, obj):
+        """Returns an opaque cursor token, which can be passed to :meth:`after`
+        or :meth:`before` to continue the query from the given record later.
+
+        :param obj: a model instance fetched by this query
         """
-        assert isinstance(spec, basestring)
-        self.__qset.order = (spec, 'ASC')
-        if spec.startswith('-'):
-            self.__qset.order = (spec[1:], 'DESC')
+        columns = self.__qset.seek_columns()
+        return encode_cursor(columns, self.__seek_values(obj))
+
+    def __seek_values(self, value):
+        columns = self.__qset.seek_columns()
+        if isinstance(value, basestring):
+            return decode_cursor(columns, value)
+        assert isinstance(value, self.__model), 'expected a model instance'
+        fields = self.__model._meta.fields
+        return [value.key if name == 'key' else \
+                fields[name].python_to_database(value._values.get(name)) \
+                for name, how in columns]
+
+    def cache(self, ttl=None):
+        """Cache the results of this query (fetched records and count) with
+        the cache configured with ``cache`` option of ``DATABASE_OPTIONS``.
+        The cached results are discarded whenever any record of the model is
+        created, updated or deleted.
+
+        >>> q = Query(Page).filter('name =', 'Wiki%').order('name').cache(60)
+        >>> total = q.count()
+        >>> pages = q.fetch(20)
+
+        :param ttl: number of seconds to cache the results for, if not given
+                    the default cache timeout is used
+        """
+        self.__qset.cache = ttl or True
         return self
 
     def fetch(self, limit, offset=0):
@@ -209,12 +854,94 @@ class Query(object):
         :returns: list of model instances or content if mapper is applied
         :rtype: list
         """
-        result = map(self.__model._from_database_values,
-                        self.__qset.fetch(limit, offset))
+        qset = self.__qset
+        if qset.group or qset.annotations:
+            result = self.__groups(
+                qset.aggregate(qset.annotations or [], limit, offset),
+                qset.group or [], qset.annotations or [])
+            if self.__mapper:
+                return map(self.__mapper, result)
+            return result
+        result = self.__load(qset.fetch(limit, offset))
+        if self.__qset.seek and self.__qset.seek[0] == 'before':
+            result.reverse()
+        return result
+
+    def _rows(self, limit, offset=0):
+        """Same as :meth:`fetch` but returns the database rows as they are
+        fetched, without creating model instances.
+        """
+        return self.__qset.fetch(limit, offset)
+
+    def iterate(self, batch_size=100):
+        """Iterate over all the records matched by this query.
+
+        Unlike :meth:`fetch`, the records are not loaded all at once. The
+        database engine streams them from a single cursor in chunks of
+        `batch_size` rows and model instances are created lazily as the
+        iteration proceeds. Iterating over the query object directly is
+        same as calling this method with default `batch_size`.
+
+        >>> q = Query(User).filter("name =", "some%").order("name")
+        >>> for obj in q.iterate(500):
+        >>>     print obj.name
+
+        The iteration may go on after the transaction is committed. If it is
+        rolled back, the remaining records are loaded at once. On MySQL they
+        are loaded whenever another statement is run while iterating too.
+
+        The records of a query continued with :meth:`before` can't be streamed
+        in the query order, use :meth:`fetch` instead.
+
+        :param batch_size: number of records to be fetched per round trip
+
+        :returns: an iterator of model instances or content if mapper is applied
+        :raises: :class:`ValueError` if the query is continued with :meth:`before`
+        """
+        assert batch_size > 0, 'batch_size should be > 0'
+        if self.__qset.seek and self.__qset.seek[0] == 'before':
+            raise ValueError(
+                _('Query continued before a record can not be iterated, use fetch instead.'))
+        return self.__iterate(batch_size)
+
+    def __iterate(self, batch_size):
+        if self.__qset.group or self.__qset.annotations:
+            for item in self.fetch(-1):
+                yield item
+            return
+        for rows in self.__qset.iterate(batch_size):
+            for item in self.__load(rows):
+                yield item
+
+    def __load(self, rows):
+        if self.__qset.fields:
+            result = self.__project(rows)
+        else:
+            deferred = None
+            if self.__qset.deferred:
+                deferred = Deferred(self.__model, self.__qset.deferred)
+            result = self.__model._from_database_rows(rows, deferred)
+        if result and self.__prefetch and not self.__qset.fields:
+            meta = self.__model._meta
+            for name in self.__prefetch:
+                field = meta.fields.get(name) or meta.virtual_fields.get(name)
+                field.prefetch(result)
         if self.__mapper:
             return map(self.__mapper, result)
         return result
 
+    def __project(self, rows):
+        fields = self.__model._meta.fields
+        convs = [(name, fields[name].database_to_python) \
+                 for name in self.__qset.fields]
+        if self.__rows is dict:
+            return [dict([(name, conv(row[name])) for name, conv in convs]) \
+                    for row in rows]
+        if len(convs) == 1 and self.__rows is None:
+            name, conv = convs[0]
+            return [conv(row[name]) for row in rows]
+        return [tuple([conv(row[name]) for name, conv in convs]) for row in rows]
+
     def fetchone(self, offset=0):
         """Fetch a single record from the query object with given offset.
 
@@ -233,11 +960,33 @@ class Query(object):
         """
         return self.fetchone()
 
-    def count(self):
-        """Return the number of records in the query object.
+    def count(self, approximate=False):
+        """Return the number of records in the query object, or the number of
+        groups if the query is grouped (see :meth:`group_by`).
+
+        The identical counts are computed only once within an active
+        :class:`IdentityMap`, unless the records are changed in between.
+
+        If `approximate` is True, the number is estimated from the statistics
+        of the database planner if supported by the database engine, which
+        is much faster for the large tables.
+
+        :param approximate: whether an estimated number is sufficient
         """
+        if approximate:
+            result = self.__qset.estimate()
+            if result is not None:
+                return result
         return self.__qset.count()
 
+    def exists(self):
+        """Check whether the query matches any record, without counting all
+        of them.
+
+        :returns: True if any record matched else False
+        """
+        return self.__qset.exists()
+
     def delete(self):
         """Delete all records matched by this query.
 
@@ -246,11 +995,22 @@ class Query(object):
         >>> Query(User).filter('name =', 'some%').delete()
 
         will delete all the User records by matching name starting with 'some'.
+
+        The records are deleted with a single statement, if supported by the
+        database engine, without loading them. The referenced records are
+        handled according to the `cascade` rules of the :class:`ManyToOne`
+        fields referencing this model.
+
+        :returns: number of records deleted
+        :raises: :class:`DatabaseError`, :class:`IntegrityError`
         """
-        for obj in self.fetch(-1):
-            obj.delete()
+        imap = IdentityMap.current()
+        if imap is not None:
+            imap.evict(self.__model)
 
-    def update(self, **kw):
+        return self.__qset.delete()
+
+    def update(self, *exprs, **kw):
         """Update all the matched records with the given keywords mapping to
         the field properties of the model of this query.
 
@@ -261,13 +1021,41 @@ class Query(object):
         will update all the User records by matching name starting with 'some'
         by updating `lang` to `en_EN`.
 
+        The records are updated with a single statement, if supported by the
+        database engine, without loading them. Arithmetic expressions can
+        be given to update field values relative to their current value:
+
+        >>> Query(Article).filter('key ==', key).update('views = views + 1')
+
+        :param exprs: update expressions of the form ``field = expression``
         :keyword kw: keyword args mapping to the field properties
+
+        :returns: number of records updated
+        :raises: :class:`ValidationError`, :class:`DatabaseError`
         """
-        for obj in self.fetch(-1):
-            for k, v in kw.items():
-                if k in obj._meta.fields:
-                    setattr(obj, k, v)
-            obj.save()
+        values = {}
+        if kw:
+            # validate values the same way as assigning them to an instance
+            obj = self.__model()
+            for name, value in kw.items():
+                if name not in obj._meta.fields or name == 'key':
+                    raise AttributeError(
+                        _('No such field %(name)r in model %(model)r',
+                            name=name, model=obj._meta.name))
+                setattr(obj, name, value)
+                values[name] = obj._values.get(name)
+        for expr in exprs:
+            if not isinstance(expr, Expr):
+                expr = Expr(expr)
+            values[expr.name] = expr.validate(self.__model)
+        if not values:
+            return 0
+
+        imap = IdentityMap.current()
+        if imap is not None:
+            imap.evict(self.__model)
+
+        return self.__qset.update(values)
 
     def __getitem__(self, arg):
         if isinstance(arg, (int, long)):
@@ -281,18 +1069,121 @@ class Query(object):
                 _('Only integer indices are supported.'))
 
     def __iter__(self):
-        offset = -1
-        try:
-            while True:
-                offset += 1
-                yield self.fetch(1, offset)[0]
-        except Exception:
-            pass
+        return self.iterate()
+
+    def subquery(self):
+        """Returns a copy of the query set of this query to be used as value
+        of the ``in`` and ``not in`` filters of other queries. The query should
+        select a single field, the `key` if not selected any.
+
+        :raises: :class:`ValueError` if more than one fields are selected
+        """
+        qset = deepcopy(self.__qset)
+        if qset.fields and len(qset.fields) > 1:
+            raise ValueError(
+                _('Nested query should select a single field.'))
+        qset.fields = qset.fields or ['key']
+        qset.order = qset.seek = qset.deferred = None
+        qset.keyset = False
+        return qset
 
     def __deepcopy__(self, meta):
         q = Query(self.__model, self.__mapper)
         q.__qset = deepcopy(self.__qset, meta)
+        q.__prefetch = self.__prefetch[:]
+        q.__rows = self.__rows
         return q
 
     def __repr__(self):
         return repr(self.__qset)
+
+
+class Paginator(object):
+    """Paginate a query with keyset pagination (see :meth:`Query.after`). The
+    pages are identified by the cursor tokens of the first and last records
+    of the pages.
+
+    >>> paginator = Paginator(Revision.all().order('-timestamp'), 20,
+    ...                       after=request.args.get('after'))
+    >>> for revision in paginator.entries:
+    ...     print revision.note
+    >>> if paginator.has_next:
+    ...     print url_for('changes', after=paginator.next_cursor)
+
+    :param query: an instance of :class:`Query`
+    :param per_page: number of records per page
+    :param after: a cursor token, fetch the page following it
+    :param before: a cursor token, fetch the page preceding it
+
+    :raises: :class:`ValueError` if a cursor token is not valid
+    """
+
+    def __init__(self, query, per_page, after=None, before=None):
+        self.query = query
+        self.per_page = per_page
+        self.after = after
+        self.before = before
+        self._entries = None
+        self._count = None
+        self._has_next = False
+        self._has_previous = False
+
+        # validate the cursor tokens early
+        self._query = deepcopy(query).keyset()
+        if before:
+            self._query.before(before)
+        elif after:
+            self._query.after(after)
+
+    def _fetch(self):
+        if self._entries is not None:
+            return
+        entries = self._query.fetch(self.per_page + 1)
+        if self.before:
+            self._has_previous = len(entries) > self.per_page
+            self._has_next = True
+            entries = entries[-self.per_page:]
+        else:
+            self._has_next = len(entries) > self.per_page
+            self._has_previous = bool(self.after)
+            entries = entries[:self.per_page]
+        self._entries = entries
+
+    @property
+    def entries(self):
+        """The records of the current page.
+        """
+        self._fetch()
+        return self._entries
+
+    @property
+    def has_next(self):
+        self._fetch()
+        return self._has_next and bool(self._entries)
+
+    @property
+    def has_previous(self):
+        self._fetch()
+        return self._has_previous and bool(self._entries)
+
+    @property
+    def next_cursor(self):
+        """The cursor token of the next page or None.
+        """
+        if self.has_next:
+            return self.query.cursor(self._entries[-1])
+
+    @property
+    def previous_cursor(self):
+        """The cursor token of the previous page or None.
+        """
+        if self.has_previous:
+            return self.query.cursor(self._entries[0])
+
+    @property
+    def count(self):
+        """Total number of records matched by the query, counted only once.
+        """
+        if self._count is None:
+            self._count = self.query.count()
+        return self._count
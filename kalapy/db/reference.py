@@ -47,6 +47,14 @@ class IRelation(Field):
         """
         pass
 
+    def prefetch(self, instances):
+        """Fetch the related instances of all the given model instances at
+        once. Used by :meth:`Query.prefetch`.
+
+        :param instances: list of instances of the model of this field
+        """
+        raise NotImplementedError
+
     @property
     def reference(self):
         """Returns the reference class.
@@ -133,7 +141,16 @@ class ManyToOne(IRelation):
         self.reference.add_field(f)
 
     def __get__(self, model_instance, model_class):
-        return super(ManyToOne, self).__get__(model_instance, model_class)
+        if model_instance is None:
+            return self
+        value = model_instance._values.get(self.name)
+        if value is None or isinstance(value, Model):
+            return value
+        # values loaded from the database are keys, fetch the referenced
+        # instance on first access
+        value = self.reference.get(value)
+        model_instance._values[self.name] = value
+        return value
 
     def __set__(self, model_instance, value):
         if value is not None and not isinstance(value, self.reference):
@@ -142,16 +159,38 @@ class ManyToOne(IRelation):
                     name=self.name, model=self._reference.__name__))
         super(ManyToOne, self).__set__(model_instance, value)
 
+    def get_key(self, model_instance):
+        """Get the key of the instance referenced by the given model instance
+        without fetching the referenced instance from the database.
+
+        >>> revision = Revision.get(key)
+        >>> page_key = Revision.page.get_key(revision)
+
+        :param model_instance: an instance of the model of this field
+
+        :returns: key of the referenced instance or None
+        """
+        return self.python_to_database(model_instance._values.get(self.name))
+
+    def prefetch(self, instances):
+        keys = [self.get_key(obj) for obj in instances \
+                if not isinstance(obj._values.get(self.name), Model)]
+        keys = list(set([k for k in keys if k is not None]))
+        if not keys:
+            return
+        result = dict([(o.key, o) for o in self.reference.get(keys)])
+        for obj in instances:
+            value = obj._values.get(self.name)
+            if not isinstance(value, Model) and value in result:
+                obj._values[self.name] = result[value]
+
     def python_to_database(self, value):
         if isinstance(value, Model):
             return value.key
         return value
 
     def database_to_python(self, value):
-        if value is None:
-            return value
-        if not isinstance(value, self.reference):
-            return self.reference.get(value)
+        # the referenced instance is fetched lazily, see `__get__`
         return value
 
 
@@ -234,7 +273,7 @@ class O2ORel(IRelation):
         super(O2ORel, self).__set__(model_instance, value)
 
         # this is virtual field, so mark it clean
-        del model_instance._dirty[self.name]
+        model_instance._dirty &= ~self._mask
 
         if getattr(value, self.reverse_name, None) != model_instance:
             setattr(value, self.reverse_name, model_instance)
@@ -245,6 +284,17 @@ class O2ORel(IRelation):
     def prepare(self, model_class):
         pass
 
+    def prefetch(self, instances):
+        keys = [obj.key for obj in instances if obj.is_saved]
+        if not keys:
+            return
+        q = self.reference.all().filter('%s in' % self.reverse_name, keys)
+        ref_field = getattr(self.reference, self.reverse_name)
+        result = dict([(ref_field.get_key(o), o) for o in q.fetch(-1)])
+        for obj in instances:
+            if obj.is_saved:
+                obj._values[self.name] = result.get(obj.key)
+
 
 class O2MSet(object):
     """A descriptor class to access OneToMany fields.
@@ -272,12 +322,24 @@ class O2MSet(object):
         return self.__ref.all().filter('%s ==' % (self.__field.reverse_name),
                 self.__obj.key)
 
+    def __iter__(self):
+        """Iterate over the related objects. The objects fetched with
+        :meth:`Query.prefetch` are used if available.
+        """
+        try:
+            return iter(self.__obj._values[self.__field.name])
+        except KeyError:
+            if not self.__obj.is_saved:
+                return iter([])
+            return iter(self.all())
+
     def add(self, *objs):
         """Add new instances to the reference set.
 
         :raises:
             TypeError: if any given object is not an instance of referenced model
         """
+        self.__obj._values.pop(self.__field.name, None)
         for obj in self.__check(*objs):
             setattr(obj, self.__field.reverse_name, self.__obj)
             obj.save()
@@ -295,6 +357,7 @@ class O2MSet(object):
                     name=self.__field.name))
 
         self.__check(*objs)
+        self.__obj._values.pop(self.__field.name, None)
 
         from kalapy.db.engines import database
         database.delete_records(*objs)
@@ -314,15 +377,8 @@ class O2MSet(object):
                 _("objects can't be removed from %(name)r, delete the objects instead.",
                     name=self.__field.name))
 
-        from kalapy.db.engines import database
-
-        # instead of removing records at once remove them in bunches
-        l = 100
-        q = self.all()
-        result = q.fetch(l)
-        while result:
-            database.delete_records(*result)
-            result = q.fetch(l)
+        self.__obj._values.pop(self.__field.name, None)
+        self.all().delete()
 
 
 class M2MSet(object):
@@ -352,64 +408,107 @@ class M2MSet(object):
         """Returns a :class:`Query` object pre-filtered to return related objects.
         """
         self.__check()
-        #XXX: think about a better solution
-        # Use nested SELECT or JOIN, but some backends might not support that
         keys = self.__m2m.select(self.__field.target) \
-                         .filter(self.__source_eq, self.__obj.key) \
-                         .fetch(-1)
-        keys = [o.key for o in keys]
+                         .filter(self.__source_eq, self.__obj.key)
         return self.__ref.all().filter('key in', keys)
 
+    def __iter__(self):
+        """Iterate over the related objects. The objects fetched with
+        :meth:`Query.prefetch` are used if available.
+        """
+        try:
+            return iter(self.__obj._values[self.__field.name])
+        except KeyError:
+            if not self.__obj.is_saved:
+                return iter([])
+            return iter(self.all())
+
+    def __links(self, *fields):
+        return self.__m2m.select(*fields).filter(self.__source_eq, self.__obj.key)
+
+    def __unique(self, objs):
+        unsaved = [obj for obj in objs if not obj.is_saved]
+        if unsaved:
+            self.__ref.bulk_save(unsaved)
+        result = []
+        seen = set()
+        for obj in objs:
+            if obj.key not in seen:
+                result.append(obj)
+                seen.add(obj.key)
+        return result
+
+    def __link(self, objs):
+        # insert the link records of the given instances in bulk
+        if objs:
+            source, target = self.__field.source, self.__field.target
+            self.__m2m.bulk_save([self.__m2m(**{source: self.__obj, target: obj}) \
+                                  for obj in objs])
+
     def add(self, *objs):
-        """Add new instances to the reference set.
+        """Add new instances to the reference set. The instances already in
+        the set are found with a single query and the links of the others are
+        inserted in bulk.
 
         :raises:
             - `TypeError`: if any given object is not an instance of referenced model
-            - `ValueError`: if any of the given object is not saved
         """
-        keys = [obj.key for obj in self.__check(*objs) if obj.key]
-
-        if keys:
-            existing = self.__m2m.select(self.__field.target) \
-                                 .filter(self.__source_eq, self.__obj.key) \
-                                 .fetch(-1)
-            existing = [o.key for o in existing]
-            objs = [o for o in objs if o.key not in existing]
+        objs = self.__unique(self.__check(*objs))
+        self.__obj._values.pop(self.__field.name, None)
+        if not objs:
+            return
 
-        for obj in objs:
-            if not obj.is_saved:
-                obj.save()
-            m2m = self.__m2m()
-            setattr(m2m, self.__field.source, self.__obj)
-            setattr(m2m, self.__field.target, obj)
-            m2m.save()
+        existing = set(self.__links(self.__field.target) \
+                           .filter(self.__target_in, [obj.key for obj in objs]) \
+                           .fetch(-1))
+        self.__link([obj for obj in objs if obj.key not in existing])
 
     def remove(self, *objs):
-        """Removes the provided instances from the reference set.
+        """Removes the provided instances from the reference set. Only the
+        links are deleted, not the instances.
 
         :raises:
             - `TypeError`: if any given object is not an instance of referenced model
         """
         self.__check(*objs)
+        self.__obj._values.pop(self.__field.name, None)
 
-        from kalapy.db.engines import database
-        database.delete_records(*objs)
+        keys = [obj.key for obj in objs if obj.is_saved]
+        if keys:
+            self.__links().filter(self.__target_in, keys).delete()
+
+    def set(self, objs):
+        """Replace the instances of the reference set with the given instances.
+        The existing links are fetched with a single query, and the links to be
+        added and removed are inserted and deleted in bulk.
+
+        >>> group.members.set(User.all().filter('lang ==', 'en'))
+
+        :param objs: a sequence of the instances of the referenced model
+
+        :raises:
+            - `TypeError`: if any given object is not an instance of referenced model
+        """
+        objs = self.__unique(self.__check(*list(objs)))
+        self.__obj._values.pop(self.__field.name, None)
+
+        existing = self.__links(self.__field.target).fetch(-1)
+        wanted = set([obj.key for obj in objs])
+        removed = [key for key in existing if key not in wanted]
+        if removed:
+            self.__links().filter(self.__target_in, removed).delete()
+        existing = set(existing)
+        self.__link([obj for obj in objs if obj.key not in existing])
 
     def clear(self):
-        """Removes all referenced instances from the reference set.
+        """Removes all referenced instances from the reference set. Only the
+        links are deleted, not the instances.
         """
         if not self.__obj.is_saved:
             return
 
-        from kalapy.db.engines import database
-
-        # instead of removing records at once remove them in bunches
-        l = 100
-        q = self.all()
-        result = q.fetch(l)
-        while result:
-            database.delete_records(*result)
-            result = q.fetch(l)
+        self.__obj._values.pop(self.__field.name, None)
+        self.__links().delete()
 
 
 class OneToMany(IRelation):
@@ -467,6 +566,21 @@ class OneToMany(IRelation):
         f = ManyToOne(model_class, self.name, name=self.reverse_name)
         self.reference.add_field(f)
 
+    def prefetch(self, instances):
+        keys = [obj.key for obj in instances if obj.is_saved]
+        if not keys:
+            return
+        q = self.reference.all().filter('%s in' % self.reverse_name, keys)
+        ref_field = getattr(self.reference, self.reverse_name)
+        result = {}
+        for obj in q.fetch(-1):
+            result.setdefault(ref_field.get_key(obj), []).append(obj)
+        for obj in instances:
+            if obj.is_saved:
+                items = obj._values[self.name] = result.get(obj.key, [])
+                for item in items:
+                    item._values[self.reverse_name] = obj
+
     def __get__(self, model_instance, model_class):
         if model_instance is None:
             return self
@@ -568,6 +682,25 @@ class ManyToMany(IRelation):
             self.reference.add_field(f)
             f.prepare(self.reference)
 
+    def prefetch(self, instances):
+        keys = [obj.key for obj in instances if obj.is_saved]
+        if not keys:
+            return
+        source = self.m2m._meta.fields[self.source]
+        target = self.m2m._meta.fields[self.target]
+        links = self.m2m.all().filter('%s in' % self.source, keys).fetch(-1)
+        targets = list(set([target.get_key(o) for o in links]))
+        targets = dict([(o.key, o) for o in self.reference.get(targets)]) \
+                  if targets else {}
+        result = {}
+        for link in links:
+            obj = targets.get(target.get_key(link))
+            if obj is not None:
+                result.setdefault(source.get_key(link), []).append(obj)
+        for obj in instances:
+            if obj.is_saved:
+                obj._values[self.name] = result.get(obj.key, [])
+
     def __get__(self, model_instance, model_class):
 
         if model_instance is None:
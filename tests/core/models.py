@@ -51,13 +51,16 @@ class Article(db.Model):
     author = db.ManyToOne(User)
 
 class Comment(db.Model):
-    title = db.String(size=100, required=True)
+    title = db.String(size=100, required=True, indexed=True)
     pub_date = db.DateTime(default_now=True)
     text = db.Text()
     article = db.ManyToOne(Article)
     author = db.ManyToOne(User)
     parent = db.ManyToOne('Comment', reverse_name='children')
 
+    __indexes__ = [('article', '-pub_date'),
+                   db.Index('title', where='"parent" IS NULL')]
+
 class UniqueTest(db.Model):
     a = db.String()
     b = db.String()
@@ -74,6 +77,13 @@ class FieldType(db.Model):
     decimal_value = db.Decimal(max_digits=9, decimal_places=3)
     text_value = db.Text()
 
+class Country(db.Model):
+    code = db.String(size=2)
+    name = db.String()
+    notes = db.Text(lazy=True)
+
+    __cache__ = True
+
 class Cascade(db.Model):
     user1 = db.ManyToOne(User, cascade=True)
     user2 = db.ManyToOne(User, reverse_name='cascade_set2', cascade=False)
@@ -1,5 +1,9 @@
+from __future__ import with_statement
+from copy import deepcopy
 from kalapy.conf import settings
+from kalapy.db.cache import get_records, set_records
 from kalapy.db.engines import database
+from kalapy.db.fields import Deferred
 from kalapy.test import TestCase
 
 from core.models import *
@@ -27,6 +31,30 @@ class DBTest(TestCase):
         self.assertFalse(database.exists_table(Comment))
         database.create_table(Comment)
 
+    def test_indexes(self):
+        if settings.DATABASE_ENGINE == "gae":
+            return
+        indexes = dict([((tuple(i.fields), i.where), i) \
+                        for i in database.get_indexes(Comment)])
+        self.assertEqual(sorted(indexes), [(('article', '-pub_date'), None),
+                                           (('author',), None),
+                                           (('parent',), None),
+                                           (('title',), None),
+                                           (('title',), '"parent" IS NULL')])
+        self.assertEqual(len(set([i.name for i in indexes.values()])), 5)
+        for index in indexes.values():
+            self.assertTrue(database.exists_index(Comment, index.name))
+
+        # missing indexes are created for existing tables
+        name = indexes[(('author',), None)].name
+        database.drop_index(Comment, name)
+        self.assertFalse(database.exists_index(Comment, name))
+        database.create_table(Comment)
+        self.assertTrue(database.exists_index(Comment, name))
+
+        # the declared indexes are not changed
+        self.assertFalse([i for i in Comment._meta.indexes if i.name])
+
     def test_alter_table(self):
         if settings.DATABASE_ENGINE == "gae":
             return
@@ -85,6 +113,52 @@ class DBTest(TestCase):
         res = Article.all().count()
         self.assertTrue(res == 2)
 
+    def test_compile(self):
+        if settings.DATABASE_ENGINE == "gae":
+            return
+        q1 = Article.all().filter('title in', ['a', 'b']).order('-title')
+        q2 = Article.all().filter('title in', ['c', 'd']).order('-title')
+        q3 = Article.all().filter('title in', ['c', 'd', 'e']).order('-title')
+
+        s1, p1 = database.compile(q1._Query__qset, '*', 10, 0)
+        s2, p2 = database.compile(q2._Query__qset, '*', 20, 5)
+        s3, p3 = database.compile(q3._Query__qset, '*', 20, 5)
+
+        self.assertTrue(s1 is s2)
+        self.assertTrue(s3 != s2)
+        self.assertEqual(p1, ['a', 'b', 10, 0])
+        self.assertEqual(p2, ['c', 'd', 20, 5])
+
+        # only the keyset queries are ordered by the key as well
+        self.assertTrue('ORDER BY "title" DESC LIMIT' in s1)
+        s4, p4 = database.compile(q1.keyset()._Query__qset, '*', 10, 0)
+        self.assertTrue('ORDER BY "title" DESC, "key" DESC LIMIT' in s4)
+
+    def test_connection_pool(self):
+        from kalapy.db.engines import _create_database, DatabaseError
+        from kalapy.db.engines.pool import ConnectionPool
+        if settings.DATABASE_ENGINE == "gae":
+            return
+        pool = ConnectionPool(_create_database, max_size=2, timeout=0.01,
+                              pre_ping=True)
+        a = pool.checkout()
+        b = pool.checkout()
+        self.assertRaises(DatabaseError, pool.checkout)
+
+        pool.checkin(a)
+        self.assertTrue(pool.checkout() is a)
+
+        a.close()
+        pool.checkin(a)
+        c = pool.checkout()
+        self.assertTrue(c is not a and c.ping())
+        self.assertEqual(pool.size, 2)
+
+        pool.checkin(b)
+        pool.checkin(c)
+        pool.dispose()
+        self.assertEqual(pool.size, 0)
+
 
 class ModelTest(TestCase):
 
@@ -136,6 +210,26 @@ class ModelTest(TestCase):
                                    u2.address_set.all().fetch(1, 1)[0].key)
 
 
+    def test_model_bulk_save(self):
+        users = [User(name='bulk%02d' % i) for i in range(30)]
+        users[0].lang = 'en_EN'
+        articles = [Article(title='t%d' % i, author=u) for i, u in enumerate(users)]
+
+        keys = Article.bulk_save(articles, batch_size=7)
+
+        self.assertEqual(keys, [a.key for a in articles])
+        self.assertEqual(len(set(keys)), 30)
+        self.assertFalse([o for o in users + articles if o.is_dirty])
+
+        for a in Article.get(keys):
+            self.assertEqual(a.title, 't%d' % keys.index(a.key))
+            self.assertEqual(a.author.key, users[keys.index(a.key)].key)
+            self.assertEqual(a.author.name, 'bulk%02d' % keys.index(a.key))
+
+        articles[0].title = 'changed'
+        Article.bulk_save(articles)
+        self.assertEqual(Article.get(keys[0]).title, 'changed')
+
     def test_model_delete(self):
         u1 = User(name="some2")
         k1 = u1.save()
@@ -161,6 +255,27 @@ class ModelTest(TestCase):
         res = User.get([k1, k2])
         self.assertTrue(isinstance(res, list))
 
+    def test_model_load(self):
+        import datetime
+        stamp = datetime.datetime(2000, 1, 1, 10, 30)
+        a = Account(create_date=stamp)
+        a.save()
+
+        # the loaded instances are created without calling __init__, so the
+        # defaults (like default_now) don't override the stored values
+        def init(self, **kw):
+            raise AssertionError('__init__ called')
+        cls = a.__class__
+        cls.__init__ = init
+        try:
+            loaded = [Account.get(a.key),
+                      Account.all().filter('key ==', a.key).first()]
+        finally:
+            del cls.__init__
+        for obj in loaded:
+            self.assertEqual(obj.create_date, stamp)
+            self.assertFalse(obj.is_dirty)
+
     def test_model_all(self):
         u1 = User(name="some5")
         u1.save() # ensure at least one record exists
@@ -175,6 +290,60 @@ class ModelTest(TestCase):
         names = User.select('name').filter('name ==', u1.name).fetch(-1)
         self.assertTrue(names[0] == u1.name)
 
+        a1 = Article(title="some6", author=u1)
+        a1.save()
+        q = Article.select('key', 'title', 'author').filter('title ==', 'some6')
+        self.assertEqual(q.fetch(-1), [(a1.key, 'some6', u1.key)])
+        self.assertEqual(Article.select('author').filter('key ==', a1.key).first(), u1.key)
+        self.assertRaises(AttributeError, Article.select, 'nothing')
+
+    def test_model_codecs(self):
+        load = UserNotes._loader(('key', 'name', 'notes'))
+        self.assertTrue(load is UserNotes._loader(('key', 'name', 'notes')))
+        obj = load({'key': 1, 'name': 'some', 'notes': 'text'})
+        self.assertTrue(isinstance(obj, UserNotes))
+        self.assertEqual((obj.key, obj.name, obj.notes), (1, 'some', 'text'))
+        self.assertFalse(obj.is_dirty)
+
+        obj.notes = 'changed'
+        self.assertEqual(obj._to_database_values(True), {'notes': 'changed'})
+        self.assertEqual(obj._to_database_values()['name'], 'some')
+
+    def test_model_slots(self):
+        import pickle
+        u = UserNotes(name='some', notes='text')
+        self.assertFalse('_values' in u.__dict__)
+        u.extra = 1
+        self.assertEqual(u.__dict__, {'extra': 1})
+        u.save()
+        self.assertFalse(u.is_dirty)
+        u.notes = 'changed'
+        self.assertTrue(u.is_dirty)
+        self.assertEqual(u._to_database_values(True), {'notes': 'changed'})
+        u.set_dirty(False)
+        self.assertFalse(u.is_dirty)
+
+        u = pickle.loads(pickle.dumps(u))
+        self.assertEqual((u.name, u.notes, u.extra), ('some', 'changed', 1))
+
+    def test_model_values(self):
+        u1 = User(name="some7")
+        u1.save()
+        q = User.all().filter('key ==', u1.key)
+        self.assertEqual(q.values('name').fetch(-1), [{'name': 'some7'}])
+        self.assertEqual(q.tuples('name').fetch(-1), [('some7',)])
+        self.assertEqual(q.tuples('key', 'name').first(), (u1.key, 'some7'))
+        self.assertEqual(q.values().first()['key'], u1.key)
+        self.assertEqual(set(q.values().first()), set(User._meta.fields))
+
+        from decimal import Decimal
+        f = FieldType(decimal_value='1.5')
+        f.save()
+        value = FieldType.all().filter('key ==', f.key).values('decimal_value').first()
+        self.assertEqual(value, {'decimal_value': Decimal('1.5')})
+        f.delete()
+        self.assertRaises(AttributeError, User.all().values, 'nothing')
+
 
 class QueryTest(TestCase):
 
@@ -199,6 +368,298 @@ class QueryTest(TestCase):
 
         self.assertEqual(r1, r2)
 
+    def test_iterate(self):
+        for n in list('abcdefghijklmnopqrstuvwxyz'):
+            u = User(name=n)
+            u.save()
+
+        q = User.all().order('name')
+
+        r1 = [o.name for o in q.iterate(batch_size=7)]
+        r2 = list('abcdefghijklmnopqrstuvwxyz')
+        self.assertEqual(r1, r2)
+
+        r1 = [o.name for o in q.filter('name in', ['x', 'y', 'z'])]
+        self.assertEqual(r1, ['x', 'y', 'z'])
+
+        self.assertEqual(list(q.filter('name ==', 'none')), [])
+
+        # the remaining rows are buffered on rollback
+        r1 = []
+        for o in User.all().order('name').iterate(batch_size=7):
+            r1.append(o.name)
+            if o.name == 'c':
+                db.rollback()
+        self.assertEqual(r1, r2)
+        self.assertEqual(User.all().count(), 0)
+
+    def test_order(self):
+        import datetime
+        for i, n in enumerate('bacab'):
+            a = Article(title=n, pub_date=datetime.datetime(2010, 1, 1, 0, i))
+            a.save()
+
+        q = Article.all().order('title', '-pub_date')
+        self.assertEqual([(a.title, a.pub_date.minute) for a in q.fetch(-1)],
+            [('a', 3), ('a', 1), ('b', 4), ('b', 0), ('c', 2)])
+
+    def test_keyset(self):
+        import datetime
+        for i, n in enumerate('aabbbcdddde'):
+            a = Article(title=n, pub_date=datetime.datetime(2010, 1, 1, 0, i % 3))
+            a.save()
+
+        for spec in (('-title',), ('pub_date',), ('title', '-pub_date'), ()):
+            q = Article.all()
+            if spec:
+                q.order(*spec)
+            expected = [a.key for a in deepcopy(q).keyset().fetch(-1)]
+
+            page = db.Paginator(q, 3)
+            keys = []
+            while True:
+                keys.extend([a.key for a in page.entries])
+                if not page.has_next:
+                    break
+                page = db.Paginator(q, 3, after=page.next_cursor)
+            self.assertEqual(keys, expected)
+
+            keys = []
+            while True:
+                keys = [a.key for a in page.entries] + keys
+                if not page.has_previous:
+                    break
+                page = db.Paginator(q, 3, before=page.previous_cursor)
+            self.assertEqual(keys, expected)
+            self.assertEqual(page.count, len(expected))
+
+        q = Article.all().order('-title').keyset()
+        first = q.fetch(4)
+        self.assertEqual([a.key for a in Article.all().order('-title').after(first[1]).fetch(2)],
+                         [a.key for a in first[2:]])
+        self.assertRaises(ValueError, q.after, 'garbage')
+        self.assertRaises(ValueError, Article.all().order('title').after, q.cursor(first[0]))
+        self.assertRaises(ValueError, iter, Article.all().order('-title').before(first[2]))
+
+    def test_keyset_nulls(self):
+        u1 = User(name='n1')
+        u2 = User(name='n2')
+        for author in (None, u2, None, u1, u2):
+            Article(title='nulls', author=author).save()
+
+        for spec in ('author', '-author'):
+            q = Article.all().filter('title ==', 'nulls').order(spec).keyset()
+            rows = q.fetch(-1)
+            keys = [a.key for a in rows]
+            for i, obj in enumerate(rows):
+                q = Article.all().filter('title ==', 'nulls').order(spec)
+                self.assertEqual([a.key for a in q.after(obj).fetch(-1)], keys[i + 1:])
+                q = Article.all().filter('title ==', 'nulls').order(spec)
+                self.assertEqual([a.key for a in q.before(q.cursor(obj)).fetch(-1)],
+                                 keys[:i])
+
+    def test_defer(self):
+        Article.all().delete()
+        for n in 'abc':
+            Article(title=n, text=n * 3).save()
+
+        def deferred(obj, name):
+            return isinstance(obj._values.get(name), Deferred)
+
+        articles = Article.all().order('title').defer('text').fetch(-1)
+        self.assertTrue(deferred(articles[0], 'text'))
+        self.assertEqual(articles[0].text, 'aaa')
+        self.assertFalse([a for a in articles if deferred(a, 'text')])
+        self.assertEqual([a.text for a in articles], ['aaa', 'bbb', 'ccc'])
+
+        articles = Article.all().order('title').only('title').fetch(-1)
+        self.assertTrue(deferred(articles[1], 'text'))
+        self.assertTrue(deferred(articles[1], 'pub_date'))
+        self.assertFalse(deferred(articles[1], 'author'))
+        articles[1].title = 'd'
+        articles[1].save()
+        self.assertEqual(articles[1].text, 'bbb')
+
+        self.assertRaises(db.FieldError, Article.all().defer, 'author')
+        self.assertRaises(db.FieldError, Article.all().defer, 'key')
+        self.assertRaises(db.FieldError, Article.all().only, 'nothing')
+
+        c = Country(code='us', name='USA', notes='notes')
+        c.save()
+        c = Country.all().filter('key ==', c.key).first()
+        self.assertTrue(deferred(c, 'notes'))
+        self.assertEqual(c.notes, 'notes')
+
+        # the deferred values of the deleted instances are None
+        c = Country.all().filter('key ==', c.key).first()
+        c.delete()
+        self.assertEqual(c.notes, None)
+        articles = Article.all().order('title').defer('text').fetch(-1)
+        placeholder = articles[0]._values['text']
+        articles[0].delete()
+        self.assertEqual(articles[0].text, None)
+        self.assertEqual([a.text for a in articles[1:]], ['ccc', 'bbb'])
+        self.assertEqual(placeholder.instances, [])
+
+    def test_aggregate(self):
+        from decimal import Decimal
+        FieldType.all().delete()
+        for f, d, t in [(1.5, '1.5', 'a'), (2.5, '2.5', 'a'), (5.0, '5', 'b')]:
+            FieldType(float_value=f, decimal_value=d, text_value=t).save()
+
+        q = FieldType.all()
+        self.assertEqual(q.aggregate(n=db.Count(), total=db.Sum('float_value'),
+                                     low=db.Min('decimal_value'),
+                                     high=db.Max('float_value')),
+                         {'n': 3, 'total': 9.0, 'low': Decimal('1.5'), 'high': 5.0})
+        self.assertEqual(q.filter('text_value ==', 'a').aggregate(
+                            avg=db.Avg('float_value')), {'avg': 2.0})
+        self.assertEqual(q.filter('text_value ==', 'c').aggregate(
+                            n=db.Count(), total=db.Sum('float_value')),
+                         {'n': 0, 'total': None})
+
+        groups = FieldType.all().group_by('text_value').annotate(
+            n=db.Count(), total=db.Sum('float_value')).order('-n').fetch(-1)
+        self.assertEqual(groups, [{'text_value': 'a', 'n': 2, 'total': 4.0},
+                                  {'text_value': 'b', 'n': 1, 'total': 5.0}])
+
+        # the groups are counted, not the records of the first group
+        q = FieldType.all().group_by('text_value').annotate(n=db.Count())
+        self.assertEqual(q.count(), 2)
+        self.assertEqual(q.filter('float_value >', 2).count(), 2)
+        self.assertEqual(q.filter('float_value >', 3).count(), 1)
+
+        # the in-memory reducer used by the engines without aggregates
+        from kalapy.db.engines.interface import IDatabase
+        qset = FieldType.all().group_by('text_value').order('text_value')
+        qset = qset._Query__qset
+        engine = database.current()
+        self.assertEqual(IDatabase.aggregate(engine, qset,
+                            [('n', db.Count()), ('total', db.Sum('float_value'))]),
+                         [{'text_value': 'a', 'n': 2, 'total': 4.0},
+                          {'text_value': 'b', 'n': 1, 'total': 5.0}])
+
+        self.assertRaises(AttributeError, q.aggregate, total=db.Sum('nothing'))
+        self.assertRaises(AttributeError, q.group_by, 'nothing')
+        FieldType.all().delete()
+
+    def test_count(self):
+        User.all().delete()
+        for n in 'abc':
+            User(name=n).save()
+
+        q = User.all().filter('name in', ['a', 'b'])
+        self.assertTrue(q.exists())
+        self.assertFalse(User.all().filter('name ==', 'd').exists())
+        self.assertEqual(q.count(), 2)
+        self.assertEqual(q.count(approximate=True), 2)
+
+        # the changes made with raw statements are counted
+        database.cursor().execute(
+            'DELETE FROM "%s" WHERE "name" = %%s' % User._meta.table, ('a',))
+        self.assertEqual(q.count(), 1)
+
+        # counted once in an unit of work till the records are changed
+        with db.IdentityMap() as imap:
+            self.assertEqual(q.count(), 1)
+            self.assertEqual(imap.counts.values(), [1])
+            User(name='a').save()
+            self.assertEqual(imap.counts, {})
+            self.assertEqual(q.count(), 2)
+
+    def test_subquery(self):
+        u1 = User(name='sub1')
+        u2 = User(name='sub2')
+        a1 = Article(title='sub-a', author=u1)
+        a2 = Article(title='sub-b', author=u2)
+        a3 = Article(title='sub-c', author=u2)
+        for a in (a1, a2, a3):
+            a.save()
+
+        authors = Article.select('author').filter('title ==', 'sub-a')
+        q = User.all().filter('key in', authors)
+        self.assertEqual([u.key for u in q.fetch(-1)], [u1.key])
+        q = User.all().filter('name =', 'sub%').filter('key not in', authors)
+        self.assertEqual([u.key for u in q.fetch(-1)], [u2.key])
+
+        # the NULL values selected by the nested query are ignored
+        Article(title='sub-d').save()
+        authors = Article.select('author').filter('title in', ['sub-a', 'sub-d'])
+        q = User.all().filter('name =', 'sub%').filter('key not in', authors)
+        self.assertEqual([u.key for u in q.fetch(-1)], [u2.key])
+        self.assertRaises(ValueError, User.all().filter, 'key in',
+                          Article.select('key', 'author'))
+
+        q = Article.all().filter('author.name ==', 'sub2').order('title')
+        self.assertEqual([a.key for a in q.fetch(-1)], [a2.key, a3.key])
+        q = Article.all().filter(db.Q('author.name ==', 'sub1')|db.Q('title ==', 'sub-c'))
+        self.assertEqual(q.count(), 2)
+        self.assertRaises(AttributeError, Article.all().filter, 'title.name ==', 'x')
+
+    def test_subquery_cache(self):
+        settings.DATABASE_OPTIONS['cache'] = 'memory'
+        try:
+            u = User(name='bob')
+            Article(title='cached', author=u).save()
+
+            q = Article.all().filter('author.name ==', 'bob').cache(60)
+            self.assertEqual(q.count(), 1)
+            self.assertEqual(len(q.fetch(-1)), 1)
+
+            # changes to the referenced model discard the cached results
+            u.name = 'alice'
+            u.save()
+            self.assertEqual(q.count(), 0)
+            self.assertEqual(q.fetch(-1), [])
+        finally:
+            settings.DATABASE_OPTIONS.pop('cache', None)
+
+    def test_large_lists(self):
+        User.all().delete()
+        users = [User(name='large%d' % i) for i in range(10)]
+        for u in users:
+            u.save()
+        keys = [u.key for u in reversed(users)]
+
+        engine = database.current()
+        engine.max_in_size = 3
+        try:
+            self.assertEqual([u.key for u in User.get(keys)], keys)
+            self.assertEqual([u.key for u in User.get(keys[:2] + keys)], keys)
+
+            q = User.all().filter('key in', keys[:8])
+            self.assertEqual(q.count(), 8)
+            q = User.all().filter('key not in', keys[:8]).order('name')
+            self.assertEqual([u.name for u in q.fetch(-1)], ['large0', 'large1'])
+            q = Article.all().filter('author.key in', keys)
+            self.assertEqual(q.count(), 0)
+
+            # the lists staged while iterating don't change the iterated rows
+            names = []
+            for u in User.all().filter('key in', keys).iterate(2):
+                self.assertEqual(len(User.get(keys[:5])), 5)
+                names.append(u.name)
+            self.assertEqual(sorted(names), ['large%d' % i for i in range(10)])
+
+            self.assertEqual(User.all().filter('key in', keys[:5]).delete(), 5)
+            database.delete_records(*User.get(keys[5:]))
+            self.assertEqual(User.all().count(), 0)
+        finally:
+            del engine.max_in_size
+
+    def test_large_lists_rollback(self):
+        User(name='staged').save()
+        engine = database.current()
+        engine.max_in_size = 3
+        try:
+            User.get(range(1, 10))
+        finally:
+            del engine.max_in_size
+
+        # staging the lists doesn't commit the pending changes
+        database.rollback()
+        self.assertEqual(User.all().filter('name ==', 'staged').count(), 0)
+
     def test_like(self):
         User.all().delete()
         for n in ['some', 'thing', 'something', 'thingsome', 'ThingSomeThing']:
@@ -235,7 +696,7 @@ class QueryTest(TestCase):
 
         n1 = User.all().count()
         q = User.all().filter('name in', ['a', 'b', 'c'])
-        q.delete()
+        self.assertEqual(q.delete(), 3)
         n2 = User.all().count()
 
         self.assertTrue(n2 == n1 - 3)
@@ -256,8 +717,8 @@ class QueryTest(TestCase):
         q1 = q.filter('name in', ['a', 'b', 'c'])
         q2 = q.filter('name in', ['d', 'e', 'f'])
 
-        q1.update(lang='en_EN')
-        q2.update(lang='fr_FR')
+        self.assertEqual(q1.update(lang='en_EN'), 3)
+        self.assertEqual(q2.update(lang='fr_FR'), 3)
 
         n1 = q.filter('lang ==', 'en_EN').count()
         n2 = q.filter('lang ==', 'fr_FR').count()
@@ -265,6 +726,32 @@ class QueryTest(TestCase):
         self.assertTrue(n1 == 3)
         self.assertTrue(n2 == 3)
 
+        try:
+            q1.update(lang='en_IN')
+        except db.ValidationError:
+            pass
+        else:
+            self.fail()
+
+    def test_update_expression(self):
+        FieldType.all().delete()
+        for v in [1.0, 2.0, 3.0]:
+            obj = FieldType(float_value=v)
+            obj.save()
+
+        q = FieldType.all().filter('float_value >=', 2.0)
+        self.assertEqual(q.update('float_value = float_value * 2 + 1'), 2)
+
+        values = FieldType.select('float_value').order('float_value').fetchall()
+        self.assertEqual(values, [1.0, 5.0, 7.0])
+
+        try:
+            q.update('float_value = 1; drop')
+        except Exception:
+            pass
+        else:
+            self.fail()
+
 
 class FieldTest(TestCase):
 
@@ -358,6 +845,19 @@ class FieldTest(TestCase):
         except db.IntegrityError:
             self.fail()
 
+    def test_cascade_query_delete(self):
+        (u1, u2, u3), c1, (a1, a2, a3) = self.prepare_cascade()
+        try:
+            User.all().filter('key ==', u2.key).delete()
+        except db.IntegrityError:
+            pass
+        else:
+            self.fail()
+        User.all().filter('key ==', u3.key).delete()
+        assert Cascade.all().fetchone().user3 is None
+        User.all().filter('key ==', u1.key).delete()
+        assert Cascade.all().count() == 0
+
     def test_cascade_m2m_true(self):
         (u1, u2, u3), c1, (a1, a2, a3) = self.prepare_cascade()
         # test cascade = False
@@ -417,6 +917,168 @@ class FieldTest(TestCase):
         assert a.title == 'story1'
         assert a.author.key == u1.key
 
+    def test_ManyToOne_lazy(self):
+        u1 = User(name="some")
+        a1 = Article(title="story1", author=u1)
+        a1.save()
+
+        a = Article.get(a1.key)
+        assert Article.author.get_key(a) == u1.key
+        assert not isinstance(a._values['author'], db.Model)
+        assert a.author.key == u1.key
+        assert a.author is a.author
+        assert Article.author.get_key(a) == u1.key
+        assert not a.is_dirty
+
+    def test_prefetch(self):
+        u1 = User(name="u1")
+        u2 = User(name="u2")
+        g1 = Group(name="g1")
+        g2 = Group(name="g2")
+        Article.bulk_save([Article(title="s1", author=u1),
+                           Article(title="s2", author=u1),
+                           Article(title="s3", author=u2),
+                           Article(title="s4")])
+        g1.save()
+        g2.save()
+        g1.members.add(u1, u2)
+        g2.members.add(u1)
+
+        articles = Article.all().order('title').prefetch('author').fetch(-1)
+        assert [isinstance(a._values['author'], User) for a in articles] == \
+               [True, True, True, False]
+        assert [a.author and a.author.name for a in articles] == \
+               ['u1', 'u1', 'u2', None]
+
+        users = User.all().filter('key in', [u1.key, u2.key]).order('name') \
+                    .prefetch('article_set', 'groups').fetch(-1)
+        assert [sorted([a.title for a in u.article_set]) for u in users] == \
+               [['s1', 's2'], ['s3']]
+        assert [sorted([g.name for g in u.groups]) for u in users] == \
+               [['g1', 'g2'], ['g1']]
+        assert users[0].article_set.all().count() == 2
+
+        try:
+            User.all().prefetch('name')
+        except db.FieldError:
+            pass
+        else:
+            self.fail()
+
+    def test_identity_map(self):
+        u1 = User(name="some")
+        u1.save()
+        a1 = Article(title="a1", author=u1)
+        a1.save()
+
+        key = u1.key
+        assert User.get(key) is not User.get(key)
+
+        with db.IdentityMap() as imap:
+            u = User.get(key)
+            assert User.get(key) is u
+            assert User.all().filter('key ==', key).fetch(1)[0] is u
+            assert Article.get(a1.key).author is u
+
+            a = Article.get(a1.key)
+            User.all().filter('key ==', key).update(name="other")
+            assert Article.get(a1.key) is not a
+            assert User.get(key) is not u
+            assert User.get(key).name == "other"
+
+            a = Article.get(a1.key)
+            a.delete()
+            assert Article.get(a1.key) is None
+
+            User.all().filter('key ==', key).delete()
+            assert User.get(key) is None
+
+        assert db.IdentityMap.current() is None
+        db.rollback()
+
+    def test_model_cache(self):
+        settings.DATABASE_OPTIONS['cache'] = 'memory'
+        try:
+            c = Country(code='in', name='India')
+            c.save()
+            db.commit()
+            key = c.key
+
+            def change(name):
+                database.cursor().execute(
+                    'UPDATE "%s" SET "name" = %%s WHERE "key" = %%s' % \
+                    Country._meta.table, (name, key))
+                db.commit()
+
+            assert Country.get(key).name == 'India'
+            cursor = database.cursor()
+            cursor.execute('SELECT "key", "code", "name" FROM "%s" WHERE "key" = %%s' % \
+                Country._meta.table, (key,))
+            row = dict(zip(('key', 'code', 'name'), cursor.fetchone()))
+            self.assertEqual(get_records(Country, [key]), {key: row})
+
+            change('Bharat')
+            assert Country.get(key).name == 'India'
+            assert Country.get([key])[0].name == 'India'
+
+            c.name = 'Hindustan'
+            c.save()
+            assert Country.get(key).name == 'Hindustan'
+            db.rollback()
+            assert Country.get(key).name == 'Bharat'
+
+            Country.all().filter('key ==', key).update(name='India')
+            assert Country.get(key).name == 'India'
+            db.commit()
+
+            c.name = 'Bharat'
+            c.save()
+            # a concurrent request caches the old record before the commit
+            set_records(Country, [{'key': key, 'code': 'in', 'name': 'India'}])
+            db.commit()
+            assert Country.get(key).name == 'Bharat'
+
+            c.delete()
+            assert Country.get(key) is None
+            db.commit()
+        finally:
+            settings.DATABASE_OPTIONS.pop('cache', None)
+
+    def test_query_cache(self):
+        settings.DATABASE_OPTIONS['cache'] = 'memory'
+        try:
+            c = Country(code='in', name='India')
+            c.save()
+            db.commit()
+
+            q = Country.all().filter('code ==', 'in').cache(60)
+            assert q.count() == 1
+            assert q.fetch(-1)[0].name == 'India'
+
+            database.cursor().execute(
+                'UPDATE "%s" SET "name" = %%s' % Country._meta.table, ('Bharat',))
+            db.commit()
+            assert q.count() == 1
+            assert q.fetch(-1)[0].name == 'India'
+            assert Country.all().filter('code ==', 'in').fetch(-1)[0].name == 'Bharat'
+
+            Country(code='in', name='Hindustan').save()
+            assert q.count() == 2
+            assert q.fetch(-1)[0].name == 'Bharat'
+
+            # the results cached before the commit are discarded
+            database.cursor().execute(
+                'DELETE FROM "%s" WHERE "name" = %%s' % Country._meta.table, ('Hindustan',))
+            assert q.count() == 2
+            db.commit()
+            assert q.count() == 1
+
+            Country.all().delete()
+            assert q.count() == 0
+            db.commit()
+        finally:
+            settings.DATABASE_OPTIONS.pop('cache', None)
+
     def test_OneToOne(self):
         u1 = User(name="some")
         u2 = User(name="someone")
@@ -500,6 +1162,27 @@ class FieldTest(TestCase):
         assert g3.members.all().count() == 1
         assert g4.members.all().count() == 1
 
+        # adding again doesn't duplicate the links
+        g1.members.add(u1, u2, u1)
+        assert g1.members.all().count() == 2
+
+        # only the links are removed
+        u1.groups.remove(g1, g2)
+        assert u1.groups.all().count() == 2
+        assert Group.all().filter('key in', [g1.key, g2.key]).count() == 2
+        assert [u.key for u in g1.members.all().fetch(-1)] == [u2.key]
+
+        u3 = User(name="u3")
+        g1.members.set([u3, u1])
+        assert sorted([u.key for u in g1.members.all().fetch(-1)]) == \
+               sorted([u1.key, u3.key])
+        assert u2.groups.all().count() == 0
+
+        u1.groups.clear()
+        assert u1.groups.all().count() == 0
+        assert g3.members.all().count() == 0
+        assert User.all().filter('key ==', u1.key).count() == 1
+
     def test_Decimal(self):
         from decimal import Decimal
 